@@ -1,9 +1,10 @@
 from collections import defaultdict
 from contextlib import redirect_stdout
-from datetime import datetime
+from datetime import datetime, timedelta
+from gzip import open as open_gzip
 from io import StringIO
 from ipaddress import IPv4Network
-from json import dump
+from json import dump, dumps, loads
 from logging import info
 from os import listdir, makedirs, remove
 from os.path import exists, getmtime
@@ -12,6 +13,7 @@ from pathlib import Path
 from requests import get as http_get
 from ruamel import yaml
 from shutil import rmtree
+from sqlalchemy import func, LargeBinary, literal, type_coerce
 from tarfile import open as open_tar
 from time import ctime
 from traceback import format_exc
@@ -22,6 +24,53 @@ from eNMS.models import models, relationships
 
 
 class AdministrationController(BaseController):
+    @property
+    def archive_path(self):
+        return Path(self.settings["paths"]["files"] or self.path / "files") / "archive"
+
+    def archive_results(self, days=None, **kwargs):
+        days = int(days or self.settings["automation"]["archive"]["days"])
+        cutoff = str(datetime.now() - timedelta(days=days))
+        batch_size = self.settings["automation"]["result_batch_size"]
+        run, count = models["run"], defaultdict(int)
+        columns = {
+            "run": "parent_runtime",
+            "result": "parent_runtime",
+            "service_log": "runtime",
+        }
+        query = db.session.query(run.parent_runtime).filter(
+            run.runtime == run.parent_runtime,
+            run.parent_runtime < cutoff,
+            run.status != "Running",
+        )
+        while True:
+            runtimes = [runtime for runtime, in query.limit(batch_size)]
+            if not runtimes:
+                break
+            for model, column in columns.items():
+                table = models[model].__table__
+                select = table.select().where(table.c[column].in_(runtimes))
+                rows = db.session.execute(select.execution_options(stream_results=True))
+                count[model] += self.write_archive(model, rows, column)
+            run_query = db.session.query(run.id).filter(
+                run.parent_runtime.in_(runtimes)
+            )
+            run_ids = [run_id for run_id, in run_query]
+            for index in range(0, len(run_ids), batch_size):
+                batch = run_ids[index : index + batch_size]
+                db.session.query(run).filter(run.restart_run_id.in_(batch)).update(
+                    {"restart_run_id": None}, synchronize_session=False
+                )
+                for table in (db.run_device_table, db.run_pool_table):
+                    db.session.execute(table.delete().where(table.c.run_id.in_(batch)))
+            for model in ("result", "run", "service_log"):
+                db.session.query(models[model]).filter(
+                    getattr(models[model], columns[model]).in_(runtimes)
+                ).delete(synchronize_session=False)
+            db.session.commit()
+        self.log("info", f"Archived {count['run']} runs and {count['result']} results")
+        return dict(count)
+
     def authenticate_user(self, **kwargs):
         name, password = kwargs["name"], kwargs["password"]
         if not name or not password:
@@ -47,6 +96,27 @@ class AdministrationController(BaseController):
                 db.session.commit()
             return user
 
+    def compress_legacy_results(self, **kwargs):
+        batch_size, count = self.settings["automation"]["result_batch_size"], 0
+        for model, property in (("result", "result"), ("run", "state")):
+            model, last_id = models[model], 0
+            column = type_coerce(model.__table__.c[property], LargeBinary)
+            legacy = func.substr(column, 1, 1) == literal(b"\x80", LargeBinary)
+            query = db.session.query(model.id, getattr(model, property)).filter(legacy)
+            while True:
+                batch = [
+                    {"id": id, property: value}
+                    for id, value in query.filter(model.id > last_id)
+                    .order_by(model.id)
+                    .limit(batch_size)
+                ]
+                if not batch:
+                    break
+                db.session.bulk_update_mappings(model, batch)
+                db.session.commit()
+                last_id, count = batch[-1]["id"], count + len(batch)
+        return count
+
     def database_deletion(self, **kwargs):
         db.delete_all(*kwargs["deletion_types"])
 
@@ -81,6 +151,45 @@ class AdministrationController(BaseController):
         rmtree(path, ignore_errors=True)
         return path
 
+    def get_archive(self, model, start=None, end=None, **kwargs):
+        archive, records = self.archive_path, []
+        limit = self.settings["automation"]["archive"]["maximum_records"]
+        if not archive.exists():
+            return records
+        service_ids = {id for id, in db.query("service", property="id")}
+        for day in sorted(path.name for path in archive.iterdir()):
+            if start and day < start[:10] or end and day > end[:10]:
+                continue
+            path = archive / day / f"{model}.ndjson.gz"
+            if not path.exists():
+                continue
+            with open_gzip(path, "rt") as file:
+                for line in file:
+                    record = loads(line)
+                    if record.get("service_id") not in service_ids:
+                        continue
+                    if any(str(record.get(k)) != str(v) for k, v in kwargs.items()):
+                        continue
+                    records.append(record)
+                    if len(records) == limit:
+                        return records
+        return records
+
+    def get_archived_result(self, name, runtime):
+        service = db.fetch("service", name=name, allow_none=True)
+        if not service:
+            return
+        run_kwargs = {"service_id": service.id, "runtime": runtime}
+        runs = self.get_archive("run", runtime, runtime, **run_kwargs)
+        if not runs:
+            return
+        result_kwargs = {"run_id": runs[0]["id"], "device_id": None}
+        results = self.get_archive("result", runtime, runtime, **result_kwargs)
+        return {
+            "status": runs[0]["status"],
+            "result": results[0]["result"] if results else "No results yet.",
+        }
+
     def get_cluster_status(self):
         return [server.status for server in db.fetch_all("server")]
 
@@ -296,3 +405,19 @@ class AdministrationController(BaseController):
     def upload_files(self, **kwargs):
         file = kwargs["file"]
         file.save(f"{kwargs['folder']}/{file.filename}")
+
+    def write_archive(self, model, rows, column="parent_runtime"):
+        files, count = {}, 0
+        try:
+            for row in rows:
+                day = row[column][:10]
+                if day not in files:
+                    makedirs(self.archive_path / day, exist_ok=True)
+                    path = self.archive_path / day / f"{model}.ndjson.gz"
+                    files[day] = open_gzip(path, "at")
+                files[day].write(dumps(dict(row), default=str) + "\n")
+                count += 1
+        finally:
+            for file in files.values():
+                file.close()
+        return count
@@ -1,11 +1,16 @@
+from asyncio import sleep as asyncio_sleep
 from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
 from flask_login import current_user
+from functools import lru_cache
+from multiprocessing import current_process
 from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
 from netmiko.ssh_dispatcher import CLASS_MAPPER, FILE_TRANSFER_MAP
 from operator import itemgetter
 from pathlib import Path
-from re import search, sub
-from threading import Thread
+from re import search, split, sub
+from threading import Event, local, Lock, Thread
+from time import sleep, time
 from uuid import uuid4
 from warnings import warn
 
@@ -19,6 +24,8 @@ except ImportError as exc:
 
 from eNMS.controller.base import BaseController
 from eNMS.database import db
+from eNMS.models import models
+from eNMS.setup import settings
 
 
 class AutomationController(BaseController):
@@ -52,12 +59,59 @@ class AutomationController(BaseController):
     SCRAPLI_DRIVERS = CORE_PLATFORM_MAP
 
     connections_cache = {
-        library: defaultdict(dict) for library in ("netmiko", "napalm", "scrapli")
+        library: defaultdict(dict)
+        for library in ("netmiko", "napalm", "scrapli", "async_scrapli")
     }
+    connection_pool = {}
+    connection_pool_keys = {}
+    connection_pool_lock = Lock()
+    connection_pool_reaper = None
     service_db = defaultdict(lambda: {"runs": 0})
     run_db = defaultdict(dict)
     run_logs = defaultdict(lambda: defaultdict(list))
     run_stop = defaultdict(bool)
+    run_stop_events = {}
+    run_results = defaultdict(list)
+    run_results_flush_times = {}
+    run_credentials = {}
+    run_payload_locks = {}
+    run_result_index = {}
+    run_results_lock = Lock()
+    iteration_variables = local()
+    governor_jobs = defaultdict(int)
+    governor_leases = {}
+    governor_lock = Lock()
+    governor_queue = []
+    governor_renewer = None
+    governor_sessions = defaultdict(int)
+    GOVERNOR_ACQUIRE_SCRIPT = """
+        for _, key in ipairs(KEYS) do
+            redis.call("zremrangebyscore", key, "-inf", ARGV[4])
+        end
+        if redis.call("zcard", KEYS[1]) >= tonumber(ARGV[1]) then
+            return 0
+        end
+        if redis.call("zcard", KEYS[2]) >= tonumber(ARGV[2]) then
+            return -1
+        end
+        for _, key in ipairs(KEYS) do
+            redis.call("zadd", key, tonumber(ARGV[4]) + tonumber(ARGV[3]), ARGV[5])
+            redis.call("expire", key, ARGV[3])
+        end
+        return 1
+    """
+    GOVERNOR_RELEASE_SCRIPT = """
+        for _, key in ipairs(KEYS) do
+            redis.call("zrem", key, ARGV[1])
+        end
+    """
+    GOVERNOR_RENEW_SCRIPT = """
+        local expiry = tonumber(ARGV[2]) + tonumber(ARGV[1])
+        for _, key in ipairs(KEYS) do
+            redis.call("zadd", key, "XX", expiry, ARGV[3])
+            redis.call("expire", key, ARGV[1])
+        end
+    """
 
     def add_edge(self, workflow_id, subtype, source, destination):
         now = self.get_time()
@@ -77,6 +131,17 @@ class AutomationController(BaseController):
         workflow.last_modified = now
         return {"edge": workflow_edge, "update_time": now}
 
+    @asynccontextmanager
+    async def async_device_slot(self, run, device):
+        ticket = self.governor_enqueue(run, device)
+        interval = self.settings["automation"]["governor"]["poll_interval"]
+        try:
+            while self.governor_waiting(run, ticket):
+                await asyncio_sleep(interval)
+            yield
+        finally:
+            self.governor_release(ticket)
+
     def calendar_init(self, type):
         results = {}
         for instance in db.fetch_all(type):
@@ -104,6 +169,78 @@ class AutomationController(BaseController):
         ):
             db.session.delete(result)
 
+    @staticmethod
+    @lru_cache(maxsize=settings["automation"]["code_cache_size"])
+    def compile_code(source, mode):
+        if mode == "eval":
+            source = source.lstrip(" \t")
+        return compile(source, "<string>", mode)
+
+    @staticmethod
+    @lru_cache(maxsize=settings["automation"]["code_cache_size"])
+    def compile_template(template):
+        return tuple(
+            compile(segment.lstrip(" \t"), "<string>", "eval")
+            if index % 2 and segment
+            else segment
+            for index, segment in enumerate(split("{{(.*?)}}", template))
+        )
+
+    def connection_pool_acquire(self, key):
+        with self.connection_pool_lock:
+            evicted = self.connection_pool_evict()
+            entry = self.connection_pool.pop(key, None)
+        self.connection_pool_close(evicted)
+        return entry["connection"] if entry else None
+
+    def connection_pool_close(self, entries):
+        for entry in entries:
+            library, connection = entry["key"][0], entry["connection"]
+            try:
+                connection.disconnect() if library == "netmiko" else connection.close()
+            except Exception as exc:
+                self.log("error", f"Error while closing pooled connection ({exc})")
+
+    @property
+    def connection_pool_enabled(self):
+        active = self.settings["automation"]["connection_pool"]["active"]
+        return active and current_process().name == "MainProcess"
+
+    def connection_pool_evict(self, size=0):
+        settings, evicted = self.settings["automation"]["connection_pool"], []
+        entries = sorted(self.connection_pool.values(), key=itemgetter("last_used"))
+        for index, entry in enumerate(entries):
+            idle_time = time() - entry["last_used"]
+            pool_size = len(entries) - index + size
+            if idle_time > settings["idle_timeout"] or pool_size > settings["max_size"]:
+                evicted.append(self.connection_pool.pop(entry["key"]))
+        return evicted
+
+    def connection_pool_reap(self):
+        while True:
+            sleep(self.settings["automation"]["connection_pool"]["reap_interval"])
+            with self.connection_pool_lock:
+                evicted = self.connection_pool_evict()
+            self.connection_pool_close(evicted)
+
+    def connection_pool_release(self, key, connection):
+        if not self.connection_pool_enabled:
+            return False
+        entry = {"connection": connection, "key": key, "last_used": time()}
+        with self.connection_pool_lock:
+            evicted = self.connection_pool_evict(size=1)
+            if key in self.connection_pool:
+                evicted.append(entry)
+            else:
+                self.connection_pool[key] = entry
+            reaper = self.connection_pool_reaper
+            if not reaper or not reaper.is_alive():
+                reaper = Thread(target=self.connection_pool_reap, daemon=True)
+                self.connection_pool_reaper = reaper
+                reaper.start()
+        self.connection_pool_close(evicted)
+        return True
+
     def copy_service_in_workflow(self, workflow_id, **kwargs):
         service_sets = list(set(kwargs["services"].split(",")))
         service_instances = db.objectify("service", service_sets)
@@ -187,6 +324,14 @@ class AutomationController(BaseController):
                     db.delete("service", id=service.id)
         return workflow.last_modified
 
+    @contextmanager
+    def device_slot(self, run, device):
+        ticket = self.governor_acquire(run, device)
+        try:
+            yield
+        finally:
+            self.governor_release(ticket)
+
     def duplicate_workflow(self, workflow_id):
         workflow = db.fetch("workflow", id=workflow_id)
         return workflow.duplicate().serialized
@@ -209,23 +354,49 @@ class AutomationController(BaseController):
             reverse=True,
         )
 
-    def get_service_logs(self, service, runtime, start_line):
-        log_instance = db.fetch(
-            "service_log", allow_none=True, runtime=runtime, service_id=service
+    def get_service_logs(self, service, runtime, start_line, line_count=None):
+        log_model, settings = models["service_log"], self.settings["automation"]
+        chunk_query = db.query("service_log").filter(
+            log_model.runtime == runtime, log_model.service_id == service
         )
-        number_of_lines = 0
-        if log_instance:
-            logs = log_instance.content
+        sizes = [size for (size,) in chunk_query.with_entities(log_model.line_count)]
+        start_line, offset = int(start_line), 0
+        if not sizes:
+            offset = max(start_line, 0)
+            lines = self.log_queue(runtime, service, mode="get", start_line=offset)
+            lines = lines or []
+            total = offset + len(lines)
+        elif None in sizes:
+            lines = chunk_query.first().content.split("\n")
+            total = len(lines)
         else:
-            lines = (
-                self.log_queue(runtime, service, start_line=int(start_line), mode="get")
-                or []
+            lines, total = None, sum(sizes)
+        if start_line < 0:
+            start_line = max(total + start_line, 0)
+        line_count = int(line_count or settings["service_logs"]["page_size"])
+        end_line = min(start_line + line_count, total)
+        if lines is None:
+            chunks = (
+                chunk_query.filter(
+                    log_model.first_line < end_line,
+                    log_model.first_line + log_model.line_count > start_line,
+                )
+                .order_by(log_model.sequence)
+                .all()
             )
-            number_of_lines, logs = len(lines), "\n".join(lines)
+            page = []
+            for chunk in chunks:
+                chunk_start = max(start_line - chunk.first_line, 0)
+                chunk_end = end_line - chunk.first_line
+                page.extend(chunk.content.split("\n")[chunk_start:chunk_end])
+        else:
+            page = lines[start_line - offset : end_line - offset]
         return {
-            "logs": logs,
-            "refresh": not log_instance,
-            "line": int(start_line) + number_of_lines,
+            "logs": "\n".join(page),
+            "refresh": not sizes,
+            "more": end_line < total,
+            "line": end_line,
+            "total": total,
         }
 
     def get_service_state(self, path, runtime=None):
@@ -440,6 +611,161 @@ class AutomationController(BaseController):
                 key=itemgetter("text"),
             )
 
+    def governor_acquire(self, run, device):
+        ticket = self.governor_enqueue(run, device)
+        interval = self.settings["automation"]["governor"]["poll_interval"]
+        while self.governor_waiting(run, ticket):
+            ticket["granted"].wait(interval)
+        return ticket
+
+    def governor_cancel(self, ticket):
+        with self.governor_lock:
+            if ticket["granted"].is_set():
+                return False
+            self.governor_queue.remove(ticket)
+            ticket["cancelled"] = True
+            return True
+
+    def governor_dispatch(self):
+        settings, refused_devices = self.settings["automation"]["governor"], set()
+        while sum(self.governor_jobs.values()) < settings["max_jobs"]:
+            candidates = [
+                ticket
+                for ticket in self.governor_queue
+                if ticket["device"] not in refused_devices
+                and self.governor_sessions[ticket["device"]]
+                < settings["max_sessions_per_device"]
+            ]
+            if not candidates:
+                return
+            ticket = min(candidates, key=lambda t: self.governor_jobs[t["runtime"]])
+            if self.redis_queue:
+                cluster_slot = self.redis(
+                    "eval",
+                    self.GOVERNOR_ACQUIRE_SCRIPT,
+                    2,
+                    "governor/jobs",
+                    f"governor/device/{ticket['device']}",
+                    settings["max_jobs"],
+                    settings["max_sessions_per_device"],
+                    settings["redis_lease_time"],
+                    time(),
+                    ticket["lease"],
+                )
+                if cluster_slot == 0:
+                    return
+                elif cluster_slot == -1:
+                    refused_devices.add(ticket["device"])
+                    continue
+                ticket["cluster"] = cluster_slot == 1
+                self.governor_leases[ticket["lease"]] = ticket["device"]
+                renewer = self.governor_renewer
+                if not renewer or not renewer.is_alive():
+                    renewer = Thread(target=self.governor_renew_loop, daemon=True)
+                    self.governor_renewer = renewer
+                    renewer.start()
+            self.governor_queue.remove(ticket)
+            self.governor_jobs[ticket["runtime"]] += 1
+            self.governor_sessions[ticket["device"]] += 1
+            ticket["granted"].set()
+
+    def governor_enqueue(self, run, device):
+        if not self.settings["automation"]["governor"]["active"]:
+            return
+        ticket = {
+            "device": device.id,
+            "granted": Event(),
+            "lease": str(uuid4()),
+            "runtime": run.parent_runtime,
+            "start": time(),
+        }
+        with self.governor_lock:
+            self.governor_queue.append(ticket)
+            self.governor_dispatch()
+            queue_depth = len(self.governor_queue)
+        if not ticket["granted"].is_set():
+            ticket["queued"] = True
+            run.write_state("governor/queued", 1, "increment")
+            run.write_state("governor/queue_depth", queue_depth)
+        return ticket
+
+    def governor_release(self, ticket):
+        if not ticket or ticket.get("cancelled"):
+            return
+        if ticket.get("cluster"):
+            self.governor_leases.pop(ticket["lease"], None)
+            self.redis(
+                "eval",
+                self.GOVERNOR_RELEASE_SCRIPT,
+                2,
+                "governor/jobs",
+                f"governor/device/{ticket['device']}",
+                ticket["lease"],
+            )
+        with self.governor_lock:
+            for counter, key in (
+                (self.governor_jobs, ticket["runtime"]),
+                (self.governor_sessions, ticket["device"]),
+            ):
+                counter[key] -= 1
+                if not counter[key]:
+                    del counter[key]
+            self.governor_dispatch()
+
+    def governor_renew(self):
+        lease_time = self.settings["automation"]["governor"]["redis_lease_time"]
+        for lease, device in list(self.governor_leases.items()):
+            self.redis(
+                "eval",
+                self.GOVERNOR_RENEW_SCRIPT,
+                2,
+                "governor/jobs",
+                f"governor/device/{device}",
+                lease_time,
+                time(),
+                lease,
+            )
+
+    def governor_renew_loop(self):
+        while True:
+            sleep(self.settings["automation"]["governor"]["redis_lease_time"] / 3)
+            self.governor_renew()
+
+    def governor_report(self, run, ticket):
+        if not ticket or not ticket.get("queued"):
+            return
+        wait_time = int((time() - ticket["start"]) * 1000)
+        run.write_state("governor/queued", -1, "increment")
+        run.write_state("governor/wait_time_ms", wait_time, "increment")
+
+    def governor_waiting(self, run, ticket):
+        waiting = ticket and not ticket["granted"].is_set()
+        if waiting and run.stop and self.governor_cancel(ticket):
+            waiting = False
+        elif waiting and self.redis_queue:
+            with self.governor_lock:
+                self.governor_dispatch()
+            waiting = not ticket["granted"].is_set()
+        if not waiting:
+            self.governor_report(run, ticket)
+        return waiting
+
+    def init_process(self):
+        self.connections_cache = {
+            library: defaultdict(dict) for library in self.connections_cache
+        }
+        self.connection_pool, self.connection_pool_keys = {}, {}
+        self.connection_pool_lock, self.connection_pool_reaper = Lock(), None
+        self.governor_leases, self.governor_renewer = {}, None
+        self.governor_lock = Lock()
+        self.run_payload_locks = {runtime: Lock() for runtime in self.run_payload_locks}
+        self.run_result_index = {}
+        self.run_results, self.run_results_lock = defaultdict(list), Lock()
+        self.run_results_flush_times = {}
+        self.redis_buffers, self.redis_buffer_sizes = {}, {}
+        self.redis_buffer_lock, self.redis_flush_lock = Lock(), Lock()
+        self.redis_flusher = None
+
     @staticmethod
     def run(service, **kwargs):
         run_kwargs = {
@@ -563,6 +889,10 @@ class AutomationController(BaseController):
         if run and run.status == "Running":
             if self.redis_queue:
                 self.redis("set", f"stop/{run.parent_runtime}", "true")
+                self.flush_redis_buffer(run.parent_runtime)
             else:
                 self.run_stop[run.parent_runtime] = True
+                for parent_runtime, stop_event in list(self.run_stop_events.values()):
+                    if parent_runtime == run.parent_runtime:
+                        stop_event.set()
             return True
@@ -10,6 +10,7 @@ from email.utils import formatdate
 from flask_login import current_user
 from git import Repo
 from importlib import import_module
+from io import StringIO
 from importlib.util import module_from_spec, spec_from_file_location
 from json import load
 from logging.config import dictConfig
@@ -19,7 +20,7 @@ from os.path import exists
 from pathlib import Path
 from re import compile, error as regex_error
 from redis import Redis
-from redis.exceptions import ConnectionError, TimeoutError
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
 from requests import Session as RequestSession
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
@@ -29,6 +30,8 @@ from sqlalchemy import and_
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from sqlalchemy.orm import aliased, configure_mappers
 from sys import path as sys_path
+from threading import Lock, Thread
+from time import sleep
 from traceback import format_exc
 from uuid import getnode
 from warnings import warn
@@ -49,6 +52,7 @@ class BaseController:
     log_levels = ["debug", "info", "warning", "error", "critical"]
 
     rest_endpoints = [
+        "archive_results",
         "get_cluster_status",
         "get_git_content",
         "update_all_pools",
@@ -265,6 +269,9 @@ class BaseController:
             if host
             else None
         )
+        self.redis_buffers, self.redis_buffer_sizes = {}, {}
+        self.redis_buffer_lock, self.redis_flush_lock = Lock(), Lock()
+        self.redis_flusher = None
 
     def init_scheduler(self):
         self.scheduler_address = getenv("SCHEDULER_ADDR")
@@ -343,22 +350,83 @@ class BaseController:
         except (ConnectionError, TimeoutError) as exc:
             self.log("error", f"Redis Queue Unreachable ({exc})", change_log=False)
 
+    def redis_pipeline(self, *operations):
+        try:
+            pipeline = self.redis_queue.pipeline()
+            for operation, *args in operations:
+                getattr(pipeline, operation)(*args)
+            results = pipeline.execute(raise_on_error=False)
+        except RedisError as exc:
+            error = f"Redis pipeline of {len(operations)} operations failed ({exc})"
+            self.log("error", error, change_log=False)
+            return
+        for (operation, key, *_), result in zip(operations, results):
+            if isinstance(result, RedisError):
+                error = f"Redis operation '{operation}' on '{key}' failed ({result})"
+                self.log("error", error, change_log=False)
+        return results
+
+    def redis_buffer(self, runtime, operation, key, *args):
+        settings = self.settings["automation"]["redis_buffer"]
+        with self.redis_buffer_lock:
+            buffer = self.redis_buffers.setdefault(runtime, {})
+            if operation in ("hset", "hincrby"):
+                field, value = args
+                update = buffer.get(("hash", key, field))
+                if update and operation == "hincrby":
+                    update[1] = int(update[1]) + value
+                else:
+                    buffer[("hash", key, field)] = [operation, value]
+            else:
+                buffer.setdefault((operation, key), []).extend(args)
+            size = self.redis_buffer_sizes.get(runtime, 0) + 1
+            self.redis_buffer_sizes[runtime] = size
+            if not self.redis_flusher or not self.redis_flusher.is_alive():
+                self.redis_flusher = Thread(target=self.redis_flush_loop, daemon=True)
+                self.redis_flusher.start()
+        if size >= settings["size"]:
+            self.flush_redis_buffer(runtime)
+
+    def flush_redis_buffer(self, runtime=None):
+        with self.redis_flush_lock:
+            with self.redis_buffer_lock:
+                if runtime:
+                    buffers = [self.redis_buffers.pop(runtime, {})]
+                    self.redis_buffer_sizes.pop(runtime, None)
+                else:
+                    buffers = list(self.redis_buffers.values())
+                    self.redis_buffers, self.redis_buffer_sizes = {}, {}
+            operations = []
+            for buffer in buffers:
+                for (operation, *keys), values in buffer.items():
+                    if operation == "hash":
+                        operations.append((values[0], *keys, values[1]))
+                    else:
+                        operations.append((operation, *keys, *values))
+            if operations:
+                self.redis_pipeline(*operations)
+
+    def redis_flush_loop(self):
+        while True:
+            sleep(self.settings["automation"]["redis_buffer"]["flush_interval"])
+            self.flush_redis_buffer()
+
     def log_queue(self, runtime, service, log=None, mode="add", start_line=0):
         if self.redis_queue:
             key = f"{runtime}/{service}/logs"
             self.run_logs[runtime][int(service)] = None
             if mode == "add":
-                log = self.redis("lpush", key, log)
+                log = self.redis_buffer(runtime, "rpush", key, *log.split("\n"))
             else:
-                log = self.redis("lrange", key, 0, -1)
-                if log:
-                    log = log[::-1][start_line:]
+                self.flush_redis_buffer(runtime)
+                log = self.redis("lrange", key, start_line, -1)
         else:
             if mode == "add":
-                return self.run_logs[runtime][int(service)].append(log)
+                return self.run_logs[runtime][int(service)].extend(log.split("\n"))
             else:
-                full_log = getattr(self.run_logs[runtime], mode)(int(service), [])
-                log = full_log[start_line:]
+                log = getattr(self.run_logs[runtime], mode)(int(service), [])
+                if start_line:
+                    log = log[start_line:]
         return log
 
     def delete_instance(self, model, instance_id):
@@ -615,6 +683,7 @@ class BaseController:
         sender=None,
         filename=None,
         file_content=None,
+        file_path=None,
     ):
         sender = sender or self.settings["mail"]["sender"]
         message = MIMEMultipart()
@@ -625,6 +694,9 @@ class BaseController:
         message.add_header("reply-to", reply_to or self.settings["mail"]["reply_to"])
         message.attach(MIMEText(content))
         if filename:
+            if file_path:
+                with open(file_path, "rb") as file:
+                    file_content = file.read()
             attached_file = MIMEApplication(file_content, Name=filename)
             attached_file["Content-Disposition"] = f'attachment; filename="{filename}"'
             message.attach(attached_file)
@@ -647,19 +719,24 @@ class BaseController:
             return False
 
     def str_dict(self, input, depth=0):
+        with StringIO() as file:
+            self.write_dict(file, input, depth)
+            return file.getvalue()
+
+    def write_dict(self, file, input, depth=0):
         tab = "\t" * depth
         if isinstance(input, list):
-            result = "\n"
+            file.write("\n")
             for element in input:
-                result += f"{tab}- {self.str_dict(element, depth + 1)}\n"
-            return result
+                file.write(f"{tab}- ")
+                self.write_dict(file, element, depth + 1)
+                file.write("\n")
         elif isinstance(input, dict):
-            result = ""
             for key, value in input.items():
-                result += f"\n{tab}{key}: {self.str_dict(value, depth + 1)}"
-            return result
+                file.write(f"\n{tab}{key}: ")
+                self.write_dict(file, value, depth + 1)
         else:
-            return str(input)
+            file.write(str(input))
 
     def strip_all(self, input):
         return input.translate(str.maketrans("", "", f"{punctuation} "))
@@ -2,9 +2,10 @@ from ast import literal_eval
 from atexit import register
 from contextlib import contextmanager
 from flask_login import current_user
-from json import loads
+from json import dumps, loads
 from logging import error
 from os import getenv
+from pickle import loads as pickle_loads
 from sqlalchemy import (
     Boolean,
     Column,
@@ -14,6 +15,7 @@ from sqlalchemy import (
     Float,
     inspect,
     Integer,
+    LargeBinary,
     PickleType,
     String,
     Table,
@@ -23,10 +25,12 @@ from sqlalchemy.dialects.mysql.base import MSMediumBlob
 from sqlalchemy.ext.associationproxy import ASSOCIATION_PROXY
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.ext.mutable import MutableDict, MutableList
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import make_transient_to_detached, scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.collections import InstrumentedList
-from sqlalchemy.types import JSON
+from sqlalchemy.types import JSON, TypeDecorator
 from time import sleep
+from zlib import compress, decompress
 
 from eNMS.models import model_properties, models, property_types, relationships
 from eNMS.setup import database as database_settings, properties, rbac as rbac_settings
@@ -88,6 +92,23 @@ class Database:
             if self.dialect == "mysql":
                 impl = MSMediumBlob
 
+        class CompressedJSONType(TypeDecorator):
+            impl = MSMediumBlob if self.dialect == "mysql" else LargeBinary
+
+            def process_bind_param(self, value, dialect):
+                if value is None:
+                    return None
+                return compress(dumps(value, default=str).encode("utf-8"))
+
+            def process_result_value(self, value, dialect):
+                if value is None:
+                    return None
+                elif value[:1] == b"\x80":
+                    return pickle_loads(value)
+                return loads(decompress(value).decode("utf-8"))
+
+        self.CompressedJSONType = CompressedJSONType
+        self.CompressedDict = MutableDict.as_mutable(CompressedJSONType)
         self.Dict = MutableDict.as_mutable(CustomPickleType)
         self.List = MutableList.as_mutable(CustomPickleType)
         if self.dialect == "postgresql":
@@ -98,6 +119,7 @@ class Database:
         self.TinyString = String(self.columns["length"]["tiny_string_length"])
 
         default_ctypes = {
+            self.CompressedDict: {},
             self.Dict: {},
             self.List: [],
             self.LargeString: "",
@@ -127,6 +149,7 @@ class Database:
                 else:
                     column_type = {
                         Boolean: "bool",
+                        self.CompressedJSONType: "dict",
                         Integer: "int",
                         Float: "float",
                         JSON: "dict",
@@ -366,6 +389,55 @@ class Database:
                     sleep(self.retry_commit_time * (index + 1))
         return instance
 
+    def get_column_values(self, instance):
+        return {
+            column.key: getattr(instance, column.key)
+            for column in inspect(instance).mapper.column_attrs
+        }
+
+    def load_detached(self, model, properties):
+        instance = models[model].__mapper__.class_manager.new_instance()
+        for property, value in properties.items():
+            set_committed_value(instance, property, value)
+        make_transient_to_detached(instance)
+        self.session.add(instance)
+        return instance
+
+    def get_session_changes(self):
+        new_instances = [
+            (instance.__tablename__, self.get_column_values(instance))
+            for instance in self.session.new
+        ]
+        dirty_instances = []
+        for instance in self.session.dirty:
+            state = inspect(instance)
+            changes = {
+                attribute.key: getattr(instance, attribute.key)
+                for attribute in state.mapper.column_attrs
+                if state.attrs[attribute.key].history.has_changes()
+            }
+            if changes:
+                dirty_instances.append((instance.__tablename__, instance.id, changes))
+        self.session.rollback()
+        return new_instances, dirty_instances
+
+    def apply_session_changes(self, changes):
+        new_instances, dirty_instances = changes
+        for model, values in new_instances:
+            instance = models[model].__mapper__.class_manager.new_instance()
+            for property, value in values.items():
+                if value is not None:
+                    setattr(instance, property, value)
+            self.session.add(instance)
+        for model, instance_id, values in dirty_instances:
+            instance = self.session.query(models[model]).get(instance_id)
+            for property, value in values.items():
+                setattr(instance, property, value)
+
+    def init_process(self):
+        self.session.registry.clear()
+        self.engine.pool = self.engine.pool.recreate()
+
     @contextmanager
     def session_scope(self):
         try:
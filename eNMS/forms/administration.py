@@ -60,6 +60,15 @@ class ResultLogDeletionForm(BaseForm):
     date_time = StringField(type="date", label="Delete Records before")
 
 
+class ResultArchivalForm(BaseForm):
+    action = "eNMS.administration.archiveResults"
+    form_type = HiddenField(default="archive_results")
+    days = IntegerField(
+        "Archive Runs and Results older than (days)",
+        default=settings["automation"]["archive"]["days"],
+    )
+
+
 class ServerForm(BaseForm):
     action = "eNMS.base.processData"
     form_type = HiddenField(default="server")
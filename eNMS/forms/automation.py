@@ -113,6 +113,13 @@ class ServiceForm(BaseForm):
         default=1,
     )
     multiprocessing = BooleanField("Multiprocessing")
+    multiprocessing_mode = SelectField(
+        "Multiprocessing Mode",
+        choices=(
+            ("thread", "Pool of threads (I/O bound services)"),
+            ("process", "Pool of processes (CPU bound services)"),
+        ),
+    )
     max_processes = IntegerField("Maximum number of processes", default=15)
     validation_condition = SelectField(
         choices=(
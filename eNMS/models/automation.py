@@ -1,31 +1,49 @@
+from asyncio import gather, run as asyncio_run, Semaphore, sleep as asyncio_sleep
 from builtins import __dict__ as builtins
+from concurrent.futures import as_completed, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from collections import ChainMap, namedtuple
 from copy import deepcopy
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 from importlib import __import__ as importlib_import
 from io import BytesIO, StringIO
 from json import dump, load, loads
 from json.decoder import JSONDecodeError
+from multiprocessing import get_context
 from multiprocessing.pool import ThreadPool
 from napalm import get_network_driver
 from netmiko import ConnectHandler
 from os import getenv
 from paramiko import RSAKey, SFTPClient
-from re import compile, search
+from re import search
 from requests import post
 from scp import SCPClient
-from sqlalchemy import Boolean, ForeignKey, Index, Integer, or_
+from sqlalchemy import (
+    and_,
+    Boolean,
+    ForeignKey,
+    func,
+    Index,
+    inspect,
+    Integer,
+    or_,
+    select,
+    union,
+)
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import aliased, relationship
-from threading import Thread
-from time import sleep
+from sqlalchemy.orm import aliased, deferred, relationship, undefer
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
+from time import sleep, time
 from traceback import format_exc
+from types import MappingProxyType
 from warnings import warn
 from xmltodict import parse
 from xml.parsers.expat import ExpatError
 
 try:
-    from scrapli import Scrapli
+    from scrapli import AsyncScrapli, Scrapli
 except ImportError as exc:
     warn(f"Couldn't import scrapli module ({exc})")
 
@@ -47,6 +65,8 @@ class Service(AbstractBase):
 
     __tablename__ = class_type = "service"
     pool_model = True
+    asynchronous_job = False
+    parallel_iteration = False
     type = db.Column(db.SmallString)
     __mapper_args__ = {"polymorphic_identity": "service", "polymorphic_on": type}
     id = db.Column(Integer, primary_key=True)
@@ -101,6 +121,8 @@ class Service(AbstractBase):
     skip_value = db.Column(db.SmallString, default="True")
     iteration_values = db.Column(db.LargeString)
     iteration_variable_name = db.Column(db.SmallString, default="iteration_value")
+    parallel_iteration_values = db.Column(Boolean, default=False)
+    max_parallel_iteration_values = db.Column(Integer, default=5)
     iteration_devices = db.Column(db.LargeString)
     iteration_devices_property = db.Column(db.TinyString, default="ip_address")
     preprocessing = db.Column(db.LargeString)
@@ -121,6 +143,7 @@ class Service(AbstractBase):
     )
     maximum_runs = db.Column(Integer, default=1)
     multiprocessing = db.Column(Boolean, default=False)
+    multiprocessing_mode = db.Column(db.TinyString, default="thread")
     max_processes = db.Column(Integer, default=5)
     status = db.Column(db.TinyString, default="Idle")
     validation_condition = db.Column(db.TinyString, default="none")
@@ -234,7 +257,7 @@ class Result(AbstractBase):
     success = db.Column(Boolean, default=False)
     runtime = db.Column(db.TinyString)
     duration = db.Column(db.TinyString)
-    result = db.Column(db.Dict)
+    result = deferred(db.Column(db.CompressedDict))
     run_id = db.Column(Integer, ForeignKey("run.id", ondelete="cascade"))
     run = relationship("Run", back_populates="results", foreign_keys="Result.run_id")
     parent_runtime = db.Column(db.TinyString)
@@ -277,15 +300,26 @@ class Result(AbstractBase):
             constraints.append(models["result"].parent_runtime == kwargs["runtime"])
         return constraints
 
+    def table_properties(self, **kwargs):
+        if kwargs.get("rest_api_request"):
+            return super().table_properties(**kwargs)
+        return self.get_properties(exclude=["result"])
+
 
 class ServiceLog(AbstractBase):
 
     __tablename__ = type = "service_log"
+    __table_args__ = (
+        Index("ix_service_log_runtime_0", "runtime", "service_id", "sequence"),
+    )
     private = True
     log_change = False
     id = db.Column(Integer, primary_key=True)
     content = db.Column(db.LargeString)
     runtime = db.Column(db.TinyString)
+    sequence = db.Column(Integer, default=0)
+    first_line = db.Column(Integer, default=0)
+    line_count = db.Column(Integer)
     service_id = db.Column(Integer, ForeignKey("service.id"))
     service = relationship("Service", foreign_keys="ServiceLog.service_id")
 
@@ -293,6 +327,21 @@ class ServiceLog(AbstractBase):
         return f"SERVICE '{self.service}' ({self.runtime})"
 
 
+class Namespace(dict):
+    def __init__(self, layers, **variables):
+        super().__init__(variables)
+        self.layers = layers
+
+    def __missing__(self, key):
+        return self.layers[key]
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self.layers
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
 class Run(AbstractBase):
 
     __tablename__ = type = "run"
@@ -350,7 +399,7 @@ class Run(AbstractBase):
     )
     task_id = db.Column(Integer, ForeignKey("task.id", ondelete="SET NULL"))
     task = relationship("Task", foreign_keys="Run.task_id")
-    state = db.Column(db.Dict, info={"log_change": False})
+    state = db.Column(db.CompressedDict, info={"log_change": False})
     results = relationship("Result", back_populates="run", cascade="all, delete-orphan")
     model_properties = ["progress", "service_properties"]
 
@@ -414,10 +463,31 @@ class Run(AbstractBase):
         elif key in self.__dict__.get("properties", {}):
             return self.__dict__["properties"][key]
         elif set(self.__dict__) & {"service_id", "service"}:
+            snapshot = self.__dict__.get("service_snapshot") or self.freeze_service()
+            if key in snapshot.field_set:
+                return getattr(snapshot, key)
             return getattr(self.service, key)
         else:
             raise AttributeError
 
+    @staticmethod
+    @lru_cache()
+    def snapshot_class(service_type):
+        mapper = inspect(models[service_type])
+        properties = [column.key for column in mapper.column_attrs]
+        snapshot_class = namedtuple(f"{service_type}_snapshot", properties)
+        snapshot_class.field_set = frozenset(properties)
+        return snapshot_class
+
+    def freeze_service(self, properties=None):
+        snapshot_class = self.snapshot_class(self.service.type)
+        if properties is None:
+            properties = {
+                key: getattr(self.service, key) for key in snapshot_class._fields
+            }
+        self.service_snapshot = snapshot_class(**properties)
+        return self.service_snapshot
+
     def result(self, device=None, main=False):
         for result in self.results:
             if result.device_name == device:
@@ -433,12 +503,19 @@ class Run(AbstractBase):
         if self.original.state:
             return self.original.state
         elif app.redis_queue:
-            keys = app.redis("keys", f"{self.parent_runtime}/state/*")
-            if not keys:
-                return {}
-            data, state = list(zip(keys, app.redis("mget", *keys))), {}
-            for log, value in data:
-                inner_store, (*path, last_key) = state, log.split("/")[2:]
+            app.flush_redis_buffer(self.parent_runtime)
+            key, state = f"{self.parent_runtime}/state", {}
+            data, lists = app.redis_pipeline(
+                ("hgetall", key), ("smembers", f"{self.parent_runtime}/lists")
+            ) or ({}, ())
+            data, lists = list(data.items()), sorted(lists)
+            if lists:
+                list_values = app.redis_pipeline(
+                    *(("lrange", f"{key}/{field}", 0, -1) for field in lists)
+                )
+                data.extend(zip(lists, list_values or []))
+            for field, value in data:
+                inner_store, (*path, last_key) = state, field.split("/")
                 for key in path:
                     inner_store = inner_store.setdefault(key, {})
                 if value in ("False", "True"):
@@ -453,7 +530,9 @@ class Run(AbstractBase):
         if app.redis_queue:
             return bool(app.redis("get", f"stop/{self.parent_runtime}"))
         else:
-            return app.run_stop[self.parent_runtime]
+            stop_event = app.run_stop_events.get(self.runtime)
+            stopped = stop_event and stop_event[1].is_set()
+            return app.run_stop[self.parent_runtime] or bool(stopped)
 
     @property
     def progress(self):
@@ -468,40 +547,72 @@ class Run(AbstractBase):
 
     def compute_devices_from_query(_self, query, property, **locals):  # noqa: N805
         values = _self.eval(query, **locals)[0]
-        devices, not_found = set(), []
-        if isinstance(values, str):
-            values = [values]
-        for value in values:
-            if isinstance(value, models["device"]):
-                device = value
-            else:
-                device = db.fetch("device", allow_none=True, **{property: value})
-            if device:
-                devices.add(device)
-            else:
-                not_found.append(value)
-        if not_found:
-            raise Exception(f"Device query invalid targets: {', '.join(not_found)}")
-        return devices
+        values = [values] if isinstance(values, str) else list(values)
+        device_ids = {
+            value.id for value in values if isinstance(value, models["device"])
+        }
+        values = [value for value in values if not isinstance(value, models["device"])]
+        if values:
+            column = getattr(models["device"], property)
+            query = db.query("device").with_entities(models["device"].id, column)
+            matches = {}
+            for device_id, value in query.filter(column.in_(values)):
+                matches.setdefault(str(value), device_id)
+            device_ids |= set(matches.values())
+            not_found = [str(value) for value in values if str(value) not in matches]
+            if not_found:
+                raise Exception(f"Device query invalid targets: {', '.join(not_found)}")
+        return device_ids
+
+    @staticmethod
+    def fetch_devices(device_ids):
+        if not device_ids:
+            return []
+        device = models["device"]
+        return db.session.query(device).filter(device.id.in_(device_ids)).all()
+
+    @staticmethod
+    def get_pool_device_ids(pool_ids):
+        if not pool_ids:
+            return set()
+        table = db.pool_device_table
+        query = db.session.query(table.c.device_id).filter(
+            table.c.pool_id.in_(pool_ids)
+        )
+        return {device_id for device_id, in query}
+
+    @staticmethod
+    def get_service_target_ids(service_id):
+        pool_device = db.pool_device_table
+        devices, pools = db.service_target_device_table, db.service_target_pool_table
+        query = union(
+            select([devices.c.device_id]).where(devices.c.service_id == service_id),
+            select([pool_device.c.device_id]).where(
+                and_(
+                    pools.c.service_id == service_id,
+                    pool_device.c.pool_id == pools.c.pool_id,
+                )
+            ),
+        )
+        return {device_id for device_id, in db.session.execute(query)}
 
     def compute_devices(self, payload):
         service = self.placeholder or self.service
-        devices = set(self.target_devices)
-        for pool in self.target_pools:
-            devices |= set(pool.devices)
-        if not devices:
+        device_ids = {device.id for device in self.target_devices}
+        device_ids |= self.get_pool_device_ids([pool.id for pool in self.target_pools])
+        if not device_ids:
             if service.device_query:
-                devices |= self.compute_devices_from_query(
+                device_ids |= self.compute_devices_from_query(
                     service.device_query,
                     service.device_query_property,
                     payload=payload,
                 )
-            devices |= set(service.target_devices)
-            for pool in service.target_pools:
-                if self.update_target_pools:
+            if self.update_target_pools:
+                for pool in service.target_pools:
                     pool.compute_pool()
-                devices |= set(pool.devices)
-        return list(devices)
+                db.session.flush()
+            device_ids |= self.get_service_target_ids(service.id)
+        return self.fetch_devices(device_ids)
 
     def init_state(self):
         if not app.redis_queue:
@@ -515,14 +626,20 @@ class Run(AbstractBase):
         self.write_state("success", True)
 
     def write_state(self, path, value, method=None):
+        if "process_updates" in self.__dict__:
+            return self.process_updates["state"].append((path, value, method))
         if app.redis_queue:
             if isinstance(value, bool):
                 value = str(value)
-            app.redis(
-                {None: "set", "append": "lpush", "increment": "incr"}[method],
-                f"{self.parent_runtime}/state/{self.path}/{path}",
-                value,
-            )
+            key, field = f"{self.parent_runtime}/state", f"{self.path}/{path}"
+            if method == "append":
+                app.redis_buffer(self.parent_runtime, "rpush", f"{key}/{field}", value)
+                app.redis_buffer(
+                    self.parent_runtime, "sadd", f"{self.parent_runtime}/lists", field
+                )
+            else:
+                operation = "hincrby" if method == "increment" else "hset"
+                app.redis_buffer(self.parent_runtime, operation, key, field, value)
         else:
             *keys, last = f"{self.parent_runtime}/{self.path}/{path}".split("/")
             store = app.run_db
@@ -537,6 +654,11 @@ class Run(AbstractBase):
                 store.setdefault(last, []).append(value)
 
     def run(self, payload):
+        self.freeze_service()
+        if self.runtime == self.parent_runtime:
+            app.run_credentials[self.runtime] = {}
+            app.run_payload_locks[self.runtime] = Lock()
+            app.run_result_index[self.runtime] = {}
         self.init_state()
         self.write_state("status", "Running")
         start = datetime.now().replace(microsecond=0)
@@ -548,51 +670,73 @@ class Run(AbstractBase):
             self.log("error", result)
             results = {"success": False, "runtime": self.runtime, "result": result}
         finally:
-            db.session.commit()
-            state = self.get_state()
-            self.status = state["status"] = "Aborted" if self.stop else "Completed"
-            self.success = results["success"]
-            if self.update_pools_after_running:
-                for pool in db.fetch_all("pool"):
-                    pool.compute_pool()
-            if self.send_notification:
-                try:
-                    results = self.notify(results, payload)
-                except Exception:
-                    error = "\n".join(format_exc().splitlines())
-                    self.log("error", f"Notification error: {error}")
-                    results["notification"] = {"success": False, "error": error}
-            app.service_db[self.service.id]["runs"] -= 1
-            if not app.service_db[self.id]["runs"]:
-                self.service.status = "Idle"
-            now = datetime.now().replace(microsecond=0)
-            results["duration"] = self.duration = str(now - start)
-            if self.runtime == self.parent_runtime:
-                self.state = state
-                self.close_remaining_connections()
-            if self.task and not (self.task.frequency or self.task.crontab_expression):
-                self.task.is_active = False
-            results["properties"] = {
-                "run": {
-                    k: v
-                    for k, v in self.properties.items()
-                    if k not in db.private_properties_set
-                },
-                "service": self.service.get_properties(exclude=["positions"]),
-            }
-            results["trigger"] = self.trigger
-            if (
-                self.runtime == self.parent_runtime
-                or len(self.target_devices) > 1
-                or self.run_method == "once"
-            ):
-                results = self.create_result(
-                    results, run_result=self.runtime == self.parent_runtime
-                )
-            if app.redis_queue and self.runtime == self.parent_runtime:
-                app.redis("delete", *(app.redis("keys", f"{self.runtime}/*") or []))
+            try:
+                self.flush_results()
+                db.session.commit()
+                state = self.get_state()
+                self.status = state["status"] = "Aborted" if self.stop else "Completed"
+                self.success = results["success"]
+                if self.update_pools_after_running:
+                    for pool in db.fetch_all("pool"):
+                        pool.compute_pool()
+                if self.send_notification:
+                    try:
+                        results = self.notify(results, payload)
+                    except Exception:
+                        error = "\n".join(format_exc().splitlines())
+                        self.log("error", f"Notification error: {error}")
+                        results["notification"] = {"success": False, "error": error}
+                app.service_db[self.service.id]["runs"] -= 1
+                if not app.service_db[self.id]["runs"]:
+                    self.service.status = "Idle"
+                now = datetime.now().replace(microsecond=0)
+                results["duration"] = self.duration = str(now - start)
+                if self.runtime == self.parent_runtime:
+                    self.state = state
+                    self.close_remaining_connections()
+                if self.task and not (
+                    self.task.frequency or self.task.crontab_expression
+                ):
+                    self.task.is_active = False
+                results["properties"] = {
+                    "run": {
+                        k: v
+                        for k, v in self.properties.items()
+                        if k not in db.private_properties_set
+                    },
+                    "service": self.service.get_properties(exclude=["positions"]),
+                }
+                results["trigger"] = self.trigger
+                if (
+                    self.runtime == self.parent_runtime
+                    or len(self.target_devices) > 1
+                    or self.run_method == "once"
+                ):
+                    results = self.create_result(
+                        results, run_result=self.runtime == self.parent_runtime
+                    )
+                if app.redis_queue and self.runtime == self.parent_runtime:
+                    self.delete_redis_keys()
+            finally:
+                app.run_results_flush_times.pop(self.runtime, None)
+                if self.runtime == self.parent_runtime:
+                    app.run_credentials.pop(self.runtime, None)
+                    app.run_payload_locks.pop(self.runtime, None)
+                    app.run_result_index.pop(self.runtime, None)
         return results
 
+    def delete_redis_keys(self):
+        app.flush_redis_buffer(self.runtime)
+        lists = app.redis("smembers", f"{self.runtime}/lists") or []
+        services = list(app.run_logs.get(self.runtime, []))
+        app.redis(
+            "delete",
+            f"{self.runtime}/state",
+            f"{self.runtime}/lists",
+            *(f"{self.runtime}/state/{field}" for field in lists),
+            *(f"{self.runtime}/{service}/logs" for service in services),
+        )
+
     def make_results_json_compliant(self, results):
         def rec(value):
             if isinstance(value, dict):
@@ -605,14 +749,173 @@ class Run(AbstractBase):
             else:
                 return value
 
-        return rec(results)
+        with self.payload_lock if "payload" in results else nullcontext():
+            return rec(results)
+
+    @staticmethod
+    def get_device_result(payload, context, device_properties):
+        try:
+            run, device = models["run"].load_thread_context(context, device_properties)
+            return run.get_results(payload, device)
+        finally:
+            db.session.remove()
+
+    @staticmethod
+    def get_device_thread_result(payload, context, device_properties):
+        try:
+            run, device = models["run"].load_thread_context(context, device_properties)
+            results = run.get_results(payload, device, commit=False)
+            return results, db.get_session_changes()
+        finally:
+            db.session.remove()
+
+    def get_run_context(self):
+        relations = ("placeholder", "restart_run", "service", "workflow")
+        return {
+            "properties": db.get_column_values(self),
+            "relations": {
+                relation: instance and (instance.type, db.get_column_values(instance))
+                for relation, instance in zip(
+                    relations, (getattr(self, relation) for relation in relations)
+                )
+            },
+            "parent": self.parent and self.parent.get_run_context(),
+        }
+
+    def get_thread_context(self, commit=True):
+        if "thread_context" in self.__dict__:
+            return self.thread_context
+        if commit:
+            db.session.commit()
+        snapshot = self.__dict__.get("service_snapshot") or self.freeze_service()
+        return self.get_run_context(), snapshot
 
     @staticmethod
-    def get_device_result(args):
-        device_id, runtime, payload, results = args
-        device = db.fetch("device", id=device_id)
-        run = db.fetch("run", runtime=runtime)
-        results.append(run.get_results(payload, device))
+    def load_thread_context(context, device_properties=None):
+        run_context, service_snapshot, instances = *context, {}
+
+        def load(model, properties):
+            if (model, properties["id"]) not in instances:
+                instance = db.load_detached(model, properties)
+                instances[model, properties["id"]] = instance
+            return instances[model, properties["id"]]
+
+        def load_run(context):
+            relations = {
+                relation: value and load(*value)
+                for relation, value in context["relations"].items()
+            }
+            parent = context["parent"] and load_run(context["parent"])
+            return load("run", {**context["properties"], **relations, "parent": parent})
+
+        device = device_properties and load("device", device_properties)
+        run = load_run(run_context)
+        run.service_snapshot, run.thread_context = service_snapshot, context
+        return run, device
+
+    def thread_pool_run(self, payload, devices, processes):
+        self.log("info", f"Starting a pool of {processes} threads")
+        context, results = self.get_thread_context(), []
+        devices = [db.get_column_values(device) for device in devices]
+        if self.service.type == "workflow":
+            with ThreadPool(processes=processes) as pool:
+                return pool.map(
+                    partial(self.get_device_result, payload, context), devices
+                )
+        with ThreadPool(processes=processes) as pool:
+            for device_results, changes in pool.imap_unordered(
+                partial(self.get_device_thread_result, payload, context), devices
+            ):
+                db.apply_session_changes(changes)
+                results.append(device_results)
+                self.flush_full_results()
+        return results
+
+    @staticmethod
+    def init_process():
+        db.init_process()
+        app.init_process()
+
+    @staticmethod
+    def get_device_process_result(args):
+        run_id, service_properties, device_properties, payload = args
+        run = db.session.query(models["run"]).get(run_id)
+        run.freeze_service(service_properties)
+        run.thread_context = run.get_thread_context(commit=False)
+        run.process_updates = {"state": [], "logs": []}
+        device = db.load_detached("device", device_properties)
+        results = run.get_results(payload, device, commit=False)
+        results = run.make_results_json_compliant(results)
+        run.close_device_connection(device.name, release=True)
+        process_updates = run.__dict__.pop("process_updates")
+        with app.run_results_lock:
+            device_results = app.run_results.pop(run.runtime, [])
+        return results, device_results, process_updates, db.get_session_changes()
+
+    def process_pool_run(self, payload, devices, processes):
+        if self.service.type == "workflow":
+            self.log("info", "Workflows cannot run in process mode, using threads")
+            return self.thread_pool_run(payload, devices, processes)
+        self.log("info", f"Starting a pool of {processes} processes")
+        mp_context = get_context("fork")
+        app.run_stop_events[self.runtime] = (self.parent_runtime, mp_context.Event())
+        try:
+            return self.process_pool_results(payload, devices, processes, mp_context)
+        finally:
+            app.run_stop_events.pop(self.runtime, None)
+
+    def process_pool_results(self, payload, devices, processes, mp_context):
+        results, futures = [], []
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=mp_context,
+            initializer=self.init_process,
+        ) as pool:
+            for device in devices:
+                ticket = app.governor_acquire(self, device) if self.governed else None
+                process_args = (
+                    self.id,
+                    self.service_snapshot._asdict(),
+                    db.get_column_values(device),
+                    payload,
+                )
+                future = pool.submit(self.get_device_process_result, process_args)
+                future.add_done_callback(
+                    lambda _, ticket=ticket: app.governor_release(ticket)
+                )
+                futures.append(future)
+            device_names = {device.id: device.name for device in devices}
+            for future in futures:
+                device_results, device_result_rows, updates, changes = future.result()
+                db.apply_session_changes(changes)
+                with app.run_results_lock:
+                    app.run_results[self.runtime].extend(device_result_rows)
+                for row in device_result_rows:
+                    self.index_result(device_names[row["device_id"]], row["result"])
+                for path, value, method in updates["state"]:
+                    self.write_state(path, value, method)
+                for log in updates["logs"]:
+                    app.log_queue(*log)
+                results.append(device_results)
+                self.flush_full_results()
+        return results
+
+    async def async_device_run(self, payload, devices):
+        semaphore = Semaphore(self.max_concurrent_sessions)
+
+        async def get_device_results(device):
+            async with semaphore:
+                return await self.async_get_results(payload, device)
+
+        return await gather(*map(get_device_results, devices))
+
+    def event_loop_run(self, payload, devices):
+        self.log(
+            "info",
+            f"Starting an event loop for {len(devices)} devices"
+            f" ({self.max_concurrent_sessions} concurrent sessions)",
+        )
+        return asyncio_run(self.async_device_run(payload, devices))
 
     def device_iteration(self, payload, device):
         derived_devices = self.compute_devices_from_query(
@@ -625,9 +928,6 @@ class Run(AbstractBase):
             commit=True,
             **{
                 "service": self.service.id,
-                "target_devices": [
-                    derived_device.id for derived_device in derived_devices
-                ],
                 "workflow": self.workflow.id,
                 "parent_device": device.id,
                 "restart_run": self.restart_run,
@@ -636,18 +936,51 @@ class Run(AbstractBase):
             },
         )
         derived_run.properties = self.properties
+        derived_run.target_devices = self.fetch_devices(derived_devices)
         success = derived_run.run(payload)["success"]
         return success
 
+    @staticmethod
+    def get_device_iteration_result(run_id, device_id, payload):
+        try:
+            run = db.fetch("run", id=run_id, rbac=None)
+            device = db.fetch("device", id=device_id, rbac=None)
+            success = run.device_iteration(payload, device)
+            db.session.commit()
+            return success
+        finally:
+            db.session.remove()
+
+    def iteration_pool_run(self, payload, processes):
+        self.log("info", f"Starting a pool of {processes} threads for device iteration")
+        db.session.commit()
+        with ThreadPoolExecutor(max_workers=processes) as pool:
+            futures = {
+                pool.submit(
+                    self.get_device_iteration_result, self.id, device.id, payload
+                ): device.name
+                for device in self.target_devices
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
     def device_run(self, payload):
         self.target_devices = self.compute_devices(payload)
-        if self.runtime == self.parent_runtime:
-            allowed_targets = db.query("device", rbac="target", username=self.creator)
-            unauthorized_targets = set(self.target_devices) - set(allowed_targets)
+        if self.runtime == self.parent_runtime and self.target_devices:
+            allowed_targets = db.query(
+                "device", rbac="target", username=self.creator, property="id"
+            )
+            device, target_ids = models["device"], [d.id for d in self.target_devices]
+            unauthorized_targets = [
+                name
+                for name, in db.session.query(device.name).filter(
+                    device.id.in_(target_ids), device.id.notin_(allowed_targets)
+                )
+            ]
             if unauthorized_targets:
                 result = (
                     f"Error 403: User '{self.creator}' is not allowed to use these"
-                    f" devices as targets: {', '.join(map(str, unauthorized_targets))}"
+                    f" devices as targets: {', '.join(unauthorized_targets)}"
                 )
                 self.log("info", result, logger="security")
                 return {"result": result, "success": False}
@@ -656,10 +989,18 @@ class Run(AbstractBase):
             if not self.workflow:
                 result = "Device iteration not allowed outside of a workflow"
                 return {"success": False, "result": result, "runtime": self.runtime}
-            for device in self.target_devices:
-                key = "success" if self.device_iteration(payload, device) else "failure"
+            if self.multiprocessing and len(self.target_devices) > 1:
+                processes = min(len(self.target_devices), self.max_processes)
+                iteration_results = self.iteration_pool_run(payload, processes)
+            else:
+                iteration_results = (
+                    (device.name, self.device_iteration(payload, device))
+                    for device in self.target_devices
+                )
+            for device_name, success in iteration_results:
+                key = "success" if success else "failure"
                 self.write_state(f"progress/device/{key}", 1, "increment")
-                summary[key].append(device.name)
+                summary[key].append(device_name)
             return {
                 "success": not summary["failure"],
                 "summary": summary,
@@ -712,22 +1053,23 @@ class Run(AbstractBase):
                 )
                 self.log("error", error)
                 return {"success": False, "runtime": self.runtime, "result": error}
-            if self.multiprocessing and len(non_skipped_targets) > 1:
+            if hasattr(self.service, "credentials"):
+                self.resolve_credentials(non_skipped_targets)
+            if self.service.asynchronous_job:
+                results.extend(self.event_loop_run(payload, non_skipped_targets))
+            elif self.multiprocessing and len(non_skipped_targets) > 1:
                 processes = min(len(non_skipped_targets), self.max_processes)
-                process_args = [
-                    (device.id, self.runtime, payload, results)
-                    for device in non_skipped_targets
-                ]
-                self.log("info", f"Starting a pool of {processes} threads")
-                with ThreadPool(processes=processes) as pool:
-                    pool.map(self.get_device_result, process_args)
+                if self.multiprocessing_mode == "process":
+                    results.extend(
+                        self.process_pool_run(payload, non_skipped_targets, processes)
+                    )
+                else:
+                    results.extend(
+                        self.thread_pool_run(payload, non_skipped_targets, processes)
+                    )
             else:
-                results.extend(
-                    [
-                        self.get_results(payload, device, commit=False)
-                        for device in non_skipped_targets
-                    ]
-                )
+                for device in non_skipped_targets:
+                    results.append(self.get_results(payload, device))
             for result in results:
                 key = "success" if result["success"] else "failure"
                 summary[key].append(result["device_target"])
@@ -738,7 +1080,7 @@ class Run(AbstractBase):
             }
 
     def create_result(self, results, device=None, commit=True, run_result=False):
-        self.success = results["success"]
+        self.success = success = results["success"]
         results = self.make_results_json_compliant(results)
         result_kw = {
             "run": self,
@@ -755,22 +1097,160 @@ class Run(AbstractBase):
             services = list(app.run_logs.get(self.runtime, []))
             for service_id in services:
                 logs = app.log_queue(self.runtime, service_id, mode="get")
-                db.factory(
-                    "service_log",
-                    runtime=self.runtime,
-                    service=service_id,
-                    content="\n".join(logs or []),
-                )
+                self.save_service_logs(service_id, logs or [])
             if self.trigger == "REST":
                 results["devices"] = {}
-                for result in self.results:
+                query = db.session.query(models["result"]).options(undefer("result"))
+                for result in query.filter_by(run_id=self.id):
                     results["devices"][result.device.name] = result.result
-        create_failed_results = self.disable_result_creation and not self.success
+        create_failed_results = self.disable_result_creation and not success
         if not self.disable_result_creation or create_failed_results or run_result:
-            db.factory("result", result=results, commit=commit, **result_kw)
+            self.index_result(getattr(device, "name", None), results)
+            if device:
+                self.buffer_result(results, device, commit)
+            else:
+                db.factory("result", result=results, commit=commit, **result_kw)
         return results
 
-    def run_service_job(self, payload, device):
+    def index_result(self, device_name, results):
+        index = app.run_result_index.get(self.parent_runtime)
+        if index is None:
+            return
+        index_size = app.settings["automation"]["result_index_size"]
+        with app.run_results_lock:
+            for property in ("scoped_name", "name"):
+                index[property, getattr(self.service, property), device_name] = results
+            while len(index) > index_size:
+                del index[next(iter(index))]
+
+    def save_service_logs(self, service_id, logs):
+        settings = app.settings["automation"]["service_logs"]
+        max_length = db.columns["length"]["large_string_length"]
+        chunks, chunk, length = [], [], 0
+        for line in "\n".join(logs).split("\n"):
+            if chunk and (
+                len(chunk) == settings["chunk_size"] or length + len(line) > max_length
+            ):
+                chunks.append(chunk)
+                chunk, length = [], 0
+            chunk.append(line)
+            length += len(line) + 1
+        chunks.append(chunk)
+        first_line, service_logs = 0, []
+        for sequence, chunk in enumerate(chunks):
+            service_logs.append(
+                {
+                    "content": "\n".join(chunk),
+                    "runtime": self.runtime,
+                    "service_id": service_id,
+                    "sequence": sequence,
+                    "first_line": first_line,
+                    "line_count": len(chunk),
+                }
+            )
+            first_line += len(chunk)
+        db.session.bulk_insert_mappings(models["service_log"], service_logs)
+
+    def buffer_result(self, results, device, commit=True):
+        result = {
+            "result": results,
+            "success": results["success"],
+            "runtime": results["runtime"],
+            "duration": results["duration"],
+            "run_id": self.id,
+            "service_id": self.service_id,
+            "parent_runtime": self.parent_runtime,
+            "workflow_id": self.workflow_id,
+            "parent_device_id": self.parent_device_id,
+            "device_id": device.id,
+        }
+        with app.run_results_lock:
+            app.run_results[self.runtime].append(result)
+        if commit and "process_updates" not in self.__dict__:
+            self.flush_full_results(commit=True)
+
+    def flush_full_results(self, commit=False):
+        settings = app.settings["automation"]
+        with app.run_results_lock:
+            buffer_size = len(app.run_results.get(self.runtime, []))
+            last_flush = app.run_results_flush_times.setdefault(self.runtime, time())
+        if buffer_size >= settings["result_batch_size"]:
+            self.flush_results(commit=commit)
+        elif buffer_size and time() - last_flush >= settings["result_flush_interval"]:
+            self.flush_results(commit=True)
+
+    def flush_results(self, commit=False):
+        with app.run_results_lock:
+            results = app.run_results.pop(self.runtime, [])
+            app.run_results_flush_times[self.runtime] = time()
+        if not results:
+            return
+        batch_size = app.settings["automation"]["result_batch_size"]
+        for index in range(0, len(results), batch_size):
+            batch = results[index : index + batch_size]
+            db.session.bulk_insert_mappings(models["result"], batch)
+        if commit:
+            db.session.commit()
+        db.session.expire(self, ["results"])
+
+    @property
+    def governed(self):
+        in_process = "process_updates" in self.__dict__
+        return self.service.type != "workflow" and not in_process
+
+    def device_slot(self, device):
+        if not device or not self.governed:
+            return nullcontext()
+        return app.device_slot(self, device)
+
+    def preprocess_job(self, payload, device, retries, total_retries, args):
+        if self.number_of_retries - retries:
+            retry = self.number_of_retries - retries
+            self.log("error", f"RETRY n°{retry}", device)
+        if self.service.preprocessing:
+            try:
+                self.eval(self.service.preprocessing, function="exec", **locals())
+            except SystemExit:
+                pass
+
+    def postprocess_job(self, results, payload, device, retries, total_retries, args):
+        results = self.convert_result(results)
+        if "success" not in results:
+            results["success"] = True
+        if self.service.postprocessing and (
+            self.postprocessing_mode == "always"
+            or self.postprocessing_mode == "failure"
+            and not results["success"]
+            or self.postprocessing_mode == "success"
+            and results["success"]
+        ):
+            try:
+                _, exec_variables = self.eval(
+                    self.service.postprocessing, function="exec", **locals()
+                )
+                if isinstance(exec_variables.get("retries"), int):
+                    retries = exec_variables["retries"]
+            except SystemExit:
+                pass
+        run_validation = (
+            self.validation_condition == "always"
+            or self.validation_condition == "failure"
+            and not results["success"]
+            or self.validation_condition == "success"
+            and results["success"]
+        )
+        if run_validation:
+            self.validate_result(results, payload, device)
+            if self.negative_logic:
+                results["success"] = not results["success"]
+        return results, retries
+
+    def job_error(self, device, log=None):
+        result = "\n".join(format_exc().splitlines())
+        self.log("error", log or result, device)
+        return {"success": False, "result": result}
+
+    def job_attempts(self, payload, device):
         args = (device,) if device else ()
         retries, total_retries = self.number_of_retries + 1, 0
         while retries and total_retries < self.max_number_of_retries:
@@ -780,115 +1260,202 @@ class Run(AbstractBase):
             retries -= 1
             total_retries += 1
             try:
-                if self.number_of_retries - retries:
-                    retry = self.number_of_retries - retries
-                    self.log("error", f"RETRY n°{retry}", device)
-                if self.service.preprocessing:
-                    try:
-                        self.eval(
-                            self.service.preprocessing, function="exec", **locals()
-                        )
-                    except SystemExit:
-                        pass
-                try:
-                    results = self.service.job(self, payload, *args)
-                except Exception as exc:
-                    self.log("error", str(exc), device)
-                    result = "\n".join(format_exc().splitlines())
-                    results = {"success": False, "result": result}
-                results = self.convert_result(results)
-                if "success" not in results:
-                    results["success"] = True
-                if self.service.postprocessing and (
-                    self.postprocessing_mode == "always"
-                    or self.postprocessing_mode == "failure"
-                    and not results["success"]
-                    or self.postprocessing_mode == "success"
-                    and results["success"]
-                ):
-                    try:
-                        _, exec_variables = self.eval(
-                            self.service.postprocessing, function="exec", **locals()
-                        )
-                        if isinstance(exec_variables.get("retries"), int):
-                            retries = exec_variables["retries"]
-                    except SystemExit:
-                        pass
-                run_validation = (
-                    self.validation_condition == "always"
-                    or self.validation_condition == "failure"
-                    and not results["success"]
-                    or self.validation_condition == "success"
-                    and results["success"]
+                self.preprocess_job(payload, device, retries, total_retries, args)
+                results = yield
+                results, retries = self.postprocess_job(
+                    results, payload, device, retries, total_retries, args
                 )
-                if run_validation:
-                    self.validate_result(results, payload, device)
-                    if self.negative_logic:
-                        results["success"] = not results["success"]
                 if results["success"]:
                     return results
                 elif retries:
-                    sleep(self.time_between_retries)
+                    yield self.time_between_retries
             except Exception as exc:
-                self.log("error", str(exc), device)
-                result = "\n".join(format_exc().splitlines())
-                results = {"success": False, "result": result}
+                results = self.job_error(device, str(exc))
         return results
 
-    def get_results(self, payload, device=None, commit=True):
-        self.log("info", "STARTING", device)
-        start = datetime.now().replace(microsecond=0)
-        results = {"device_target": getattr(device, "name", None)}
+    def run_service_job(self, payload, device):
+        args = (device,) if device else ()
+        attempts, results = self.job_attempts(payload, device), None
         try:
-            if self.restart_run and self.service.type == "workflow":
-                old_result = self.restart_run.result(
-                    device=device.name if device else None
-                )
-                if old_result and "payload" in old_result.result:
-                    payload.update(old_result["payload"])
-            if self.service.iteration_values:
-                targets_results = {}
-                targets = list(self.eval(self.service.iteration_values, **locals())[0])
-                if not isinstance(targets, dict):
-                    targets = dict(zip(map(str, targets), targets))
-                for target_name, target_value in targets.items():
-                    self.payload_helper(
-                        payload,
-                        self.iteration_variable_name,
-                        target_value,
-                        device=getattr(device, "name", None),
-                    )
-                    targets_results[target_name] = self.run_service_job(payload, device)
-                results.update(
-                    {
-                        "result": targets_results,
-                        "success": all(r["success"] for r in targets_results.values()),
-                    }
+            while True:
+                waiting_time = attempts.send(results)
+                if waiting_time is None:
+                    try:
+                        results = self.service.job(self, payload, *args)
+                    except Exception as exc:
+                        results = self.job_error(device, str(exc))
+                else:
+                    sleep(waiting_time)
+                    results = None
+        except StopIteration as stop:
+            return stop.value
+
+    async def async_run_service_job(self, payload, device):
+        attempts, results = self.job_attempts(payload, device), None
+        try:
+            while True:
+                waiting_time = attempts.send(results)
+                if waiting_time is None:
+                    try:
+                        results = await self.service.async_job(self, payload, device)
+                    except Exception as exc:
+                        results = self.job_error(device, str(exc))
+                else:
+                    await asyncio_sleep(waiting_time)
+                    results = None
+        except StopIteration as stop:
+            return stop.value
+
+    def compute_iteration_targets(self, payload, device):
+        targets = list(self.eval(self.service.iteration_values, **locals())[0])
+        if not isinstance(targets, dict):
+            targets = dict(zip(map(str, targets), targets))
+        return targets
+
+    def get_iteration_targets(self, payload, device):
+        targets = self.compute_iteration_targets(payload, device)
+        for target_name, target_value in targets.items():
+            self.payload_helper(
+                payload,
+                self.iteration_variable_name,
+                target_value,
+                device=getattr(device, "name", None),
+            )
+            yield target_name
+
+    @staticmethod
+    def get_iteration_target_result(payload, context, device_properties, value):
+        run, device = models["run"].load_thread_context(context, device_properties)
+        variables = {run.iteration_variable_name: value}
+        app.iteration_variables.devices = {getattr(device, "name", None): variables}
+        try:
+            results = run.run_service_job(payload, device)
+            return results, db.get_session_changes()
+        finally:
+            db.session.remove()
+            del app.iteration_variables.devices
+
+    @property
+    def payload_lock(self):
+        return app.run_payload_locks.get(self.parent_runtime) or nullcontext()
+
+    def get_iteration_variables(self, device_name):
+        devices = getattr(app.iteration_variables, "devices", {})
+        return devices.get(device_name, {})
+
+    def iteration_values_pool_run(self, payload, device):
+        targets = self.compute_iteration_targets(payload, device)
+        if not targets:
+            return {}
+        processes = min(len(targets), self.max_parallel_iteration_values)
+        self.log("info", f"Starting a pool of {processes} threads", device)
+        context = self.get_thread_context()
+        device_properties = device and db.get_column_values(device)
+        futures, targets_results = {}, {}
+        last_value = list(targets.values())[-1]
+        with ThreadPoolExecutor(max_workers=processes) as pool:
+            for target_name, target_value in targets.items():
+                futures[target_name] = pool.submit(
+                    self.get_iteration_target_result,
+                    payload,
+                    context,
+                    device_properties,
+                    target_value,
                 )
-            else:
-                results.update(self.run_service_job(payload, device))
-        except Exception:
-            formatted_error = "\n".join(format_exc().splitlines())
-            results.update({"success": False, "result": formatted_error})
-            self.log("error", formatted_error, device)
+        for target_name, future in futures.items():
+            target_results, changes = future.result()
+            db.apply_session_changes(changes)
+            targets_results[target_name] = target_results
+        self.payload_helper(
+            payload,
+            self.iteration_variable_name,
+            last_value,
+            device=getattr(device, "name", None),
+        )
+        return targets_results
+
+    @staticmethod
+    def get_iteration_results(targets_results):
+        success = all(results["success"] for results in targets_results.values())
+        return {"result": targets_results, "success": success}
+
+    def complete_results(self, results, start, device, commit=True):
         results["duration"] = str(datetime.now().replace(microsecond=0) - start)
         if device:
-            if (
-                getattr(self, "close_connection", False)
-                or self.runtime == self.parent_runtime
-            ):
-                self.close_device_connection(device.name)
             status = "success" if results["success"] else "failure"
             self.write_state(f"progress/device/{status}", 1, "increment")
             self.create_result(
                 {"runtime": app.get_time(), **results}, device, commit=commit
             )
         self.log("info", "FINISHED", device)
+        if not results["success"]:
+            self.write_state("success", False)
         if self.waiting_time:
             self.log("info", f"SLEEP {self.waiting_time} seconds...", device)
+
+    def get_results(self, payload, device=None, commit=True):
+        self.log("info", "STARTING", device)
+        start = datetime.now().replace(microsecond=0)
+        results = {"device_target": getattr(device, "name", None)}
+        with self.device_slot(device):
+            try:
+                if self.restart_run and self.service.type == "workflow":
+                    old_result = self.restart_run.result(
+                        device=device.name if device else None
+                    )
+                    if old_result and "payload" in old_result.result:
+                        payload.update(old_result["payload"])
+                if self.service.iteration_values:
+                    parallel_iteration = self.service.parallel_iteration
+                    if parallel_iteration and self.parallel_iteration_values:
+                        targets_results = self.iteration_values_pool_run(
+                            payload, device
+                        )
+                    else:
+                        targets_results = {}
+                        targets = self.get_iteration_targets(payload, device)
+                        for target_name in targets:
+                            targets_results[target_name] = self.run_service_job(
+                                payload, device
+                            )
+                    results.update(self.get_iteration_results(targets_results))
+                else:
+                    results.update(self.run_service_job(payload, device))
+            except Exception:
+                results.update(self.job_error(device))
+            if device and (
+                getattr(self, "close_connection", False)
+                or self.runtime == self.parent_runtime
+            ):
+                release = not getattr(self, "close_connection", False)
+                self.close_device_connection(device.name, release)
+        self.complete_results(results, start, device, commit)
+        if self.waiting_time:
             sleep(self.waiting_time)
-        if not results["success"]:
-            self.write_state("success", False)
+        return results
+
+    async def async_get_results(self, payload, device):
+        self.log("info", "STARTING", device)
+        start = datetime.now().replace(microsecond=0)
+        results = {"device_target": device.name}
+        async with app.async_device_slot(self, device):
+            try:
+                if self.service.iteration_values:
+                    targets_results = {}
+                    for target_name in self.get_iteration_targets(payload, device):
+                        target_results = await self.async_run_service_job(
+                            payload, device
+                        )
+                        targets_results[target_name] = target_results
+                    results.update(self.get_iteration_results(targets_results))
+                else:
+                    results.update(await self.async_run_service_job(payload, device))
+            except Exception:
+                results.update(self.job_error(device))
+            await self.async_disconnect(device.name)
+        self.complete_results(results, start, device)
+        if self.waiting_time:
+            await asyncio_sleep(self.waiting_time)
         return results
 
     def log(
@@ -915,9 +1482,13 @@ class Run(AbstractBase):
         )
         if service_log or logger and settings.get("service_log"):
             run_log = f"{app.get_time()} - {severity} - {log}"
-            app.log_queue(self.parent_runtime, self.service.id, run_log)
-            if self.runtime != self.parent_runtime:
-                app.log_queue(self.parent_runtime, self.original.service.id, run_log)
+            service_ids = {self.service.id, self.original.service.id}
+            for service_id in service_ids:
+                if "process_updates" in self.__dict__:
+                    log_args = (self.parent_runtime, service_id, run_log)
+                    self.process_updates["logs"].append(log_args)
+                else:
+                    app.log_queue(self.parent_runtime, service_id, run_log)
 
     def build_notification(self, results, payload):
         notification = {
@@ -942,30 +1513,25 @@ class Run(AbstractBase):
     def notify(self, results, payload):
         self.log("info", f"Sending {self.send_notification_method} notification...")
         notification = self.build_notification(results, payload)
-        file_content = deepcopy(notification)
-        if self.include_device_results:
-            file_content["Device Results"] = {}
-            for device in self.target_devices:
-                device_result = db.fetch(
-                    "result",
-                    service_id=self.service_id,
-                    parent_runtime=self.parent_runtime,
-                    device_id=device.id,
-                    allow_none=True,
-                )
-                if device_result:
-                    file_content["Device Results"][device.name] = device_result.result
         if self.send_notification_method == "mail":
             filename = self.runtime.replace(".", "").replace(":", "")
             status = "PASS" if results["success"] else "FAILED"
-            result = app.send_email(
-                f"{status}: {self.service.name}",
-                app.str_dict(notification),
-                recipients=self.mail_recipient,
-                reply_to=self.reply_to,
-                filename=f"results-{filename}.txt",
-                file_content=app.str_dict(file_content),
-            )
+            content = app.str_dict(notification)
+            with NamedTemporaryFile("w", suffix=".txt") as file:
+                file.write(content)
+                if self.include_device_results:
+                    file.write("\nDevice Results: ")
+                    for device_name, result in self.get_device_results():
+                        app.write_dict(file, {device_name: result}, 1)
+                file.flush()
+                result = app.send_email(
+                    f"{status}: {self.service.name}",
+                    content,
+                    recipients=self.mail_recipient,
+                    reply_to=self.reply_to,
+                    filename=f"results-{filename}.txt",
+                    file_path=file.name,
+                )
         elif self.send_notification_method == "slack":
             result = SlackClient(getenv("SLACK_TOKEN")).api_call(
                 "chat.postMessage",
@@ -984,17 +1550,51 @@ class Run(AbstractBase):
         results["notification"] = {"success": True, "result": result}
         return results
 
+    def get_device_results(self):
+        result = models["result"]
+        device_results = (
+            db.session.query(func.min(result.id))
+            .join(
+                db.run_device_table,
+                db.run_device_table.c.device_id == result.device_id,
+            )
+            .filter(
+                db.run_device_table.c.run_id == self.id,
+                result.service_id == self.service_id,
+                result.parent_runtime == self.parent_runtime,
+            )
+            .group_by(result.device_id)
+        )
+        return (
+            db.session.query(models["device"].name, result.result)
+            .join(result, result.device_id == models["device"].id)
+            .filter(result.id.in_(device_results))
+            .yield_per(app.settings["automation"]["result_batch_size"])
+        )
+
+    @staticmethod
+    def decrypt_credentials(credentials):
+        use_private_key = credentials.subtype != "password"
+        secret = credentials.private_key if use_private_key else credentials.password
+        return {
+            "id": credentials.id,
+            "name": credentials.name,
+            "username": credentials.username,
+            "private_key" if use_private_key else "password": app.get_password(secret),
+            "secret": app.get_password(credentials.enable_password),
+        }
+
     def get_credentials(self, device):
-        result, credential_type = {}, self.original.credential_type
-        credentials = device.get_credentials(credential_type, self.creator)
-        self.log("info", f"Using '{credentials.name}' credentials for '{device.name}'")
+        result, credentials = {}, self.get_device_credentials(device)
+        name = credentials["name"]
+        self.log("info", f"Using '{name}' credentials for '{device.name}'")
         if self.credentials == "device":
-            result["username"] = credentials.username
-            if credentials.subtype == "password":
-                result["password"] = app.get_password(credentials.password)
+            result["username"] = credentials["username"]
+            if "password" in credentials:
+                result["password"] = credentials["password"]
             else:
-                private_key = app.get_password(credentials.private_key)
-                result["pkey"] = RSAKey.from_private_key(StringIO(private_key))
+                private_key = StringIO(credentials["private_key"])
+                result["pkey"] = RSAKey.from_private_key(private_key)
         elif self.credentials == "user":
             user = db.fetch("user", name=self.creator)
             result["username"] = user.name
@@ -1002,15 +1602,61 @@ class Run(AbstractBase):
         else:
             result["username"] = self.sub(self.custom_username, locals())
             password = app.get_password(self.custom_password)
-            substituted_password = self.sub(password, locals())
+            substituted_password = self.sub(password, locals(), cache=False)
             if password != substituted_password:
                 if substituted_password.startswith("b'"):
                     substituted_password = substituted_password[2:-1]
                 password = app.get_password(substituted_password)
             result["password"] = password
-        result["secret"] = app.get_password(credentials.enable_password)
+        result["secret"] = credentials["secret"]
         return result
 
+    def get_credentials_key(self, device):
+        key = (self.get_device_credentials(device)["id"], self.credentials)
+        if self.credentials == "user":
+            key += (self.creator,)
+        elif self.credentials == "custom":
+            username = self.sub(self.custom_username, locals())
+            key += (self.service.id, username, self.custom_password)
+        return key
+
+    def get_device_credentials(self, device):
+        credential_type = self.original.credential_type
+        cache = app.run_credentials.get(self.parent_runtime)
+        if cache is None:
+            credentials = device.get_credentials(credential_type, self.creator)
+            return self.decrypt_credentials(credentials)
+        if device.id not in cache.get(credential_type, {}):
+            run, devices = self, [device]
+            while run:
+                devices.extend(run.target_devices)
+                run = run.parent
+            self.resolve_credentials(devices)
+        credentials = cache[credential_type][device.id]
+        if not credentials:
+            raise Exception(f"No matching credentials found for DEVICE '{device.name}'")
+        return credentials
+
+    def resolve_credentials(self, devices):
+        cache = app.run_credentials.get(self.parent_runtime)
+        if cache is None:
+            return
+        credential_type = self.original.credential_type
+        cache = cache.setdefault(credential_type, {})
+        device_ids = {device.id for device in devices} - set(cache)
+        if not device_ids:
+            return
+        credentials = models["device"].get_bulk_credentials(
+            device_ids, credential_type, self.creator
+        )
+        decrypted = {
+            credential.id: self.decrypt_credentials(credential)
+            for credential in set(credentials.values())
+        }
+        for device_id in device_ids:
+            credential = credentials.get(device_id)
+            cache[device_id] = decrypted[credential.id] if credential else None
+
     def convert_result(self, result):
         if self.conversion_method == "none" or "result" not in result:
             return result
@@ -1097,15 +1743,20 @@ class Run(AbstractBase):
         allow_none=False,
         default=None,
     ):
-        payload = payload.setdefault("variables", {})
-        if device:
-            payload = payload.setdefault("devices", {})
-            payload = payload.setdefault(device, {})
-        if section:
-            payload = payload.setdefault(section, {})
-        if value is None:
-            value = default
-        value = getattr(payload, operation)(name, value)
+        iteration_variables = self.get_iteration_variables(device)
+        with self.payload_lock:
+            if not section and name in iteration_variables:
+                payload = iteration_variables
+            else:
+                payload = payload.setdefault("variables", {})
+                if device:
+                    payload = payload.setdefault("devices", {})
+                    payload = payload.setdefault(device, {})
+                if section:
+                    payload = payload.setdefault(section, {})
+            if value is None:
+                value = default
+            value = getattr(payload, operation)(name, value)
         if operation == "get" and not allow_none and value is None:
             raise Exception(f"Payload Editor: {name} not found in {payload}.")
         else:
@@ -1141,7 +1792,16 @@ class Run(AbstractBase):
             else:
                 return results.pop().result
 
-        return recursive_search(self)
+        index = app.run_result_index.get(self.parent_runtime)
+        if index is None:
+            return recursive_search(self)
+        for property in ("scoped_name", "name"):
+            result = index.get((property, service_name, device))
+            if result is not None:
+                return result
+        if len(index) >= app.settings["automation"]["result_index_size"]:
+            return recursive_search(self)
+        return recursive_search(self.restart_run)
 
     @staticmethod
     def _import(module, *args, **kwargs):
@@ -1154,48 +1814,98 @@ class Run(AbstractBase):
             raise db.rbac_error(f"Cannot fetch {model}s from workflow builder.")
         return getattr(db, func)(model, rbac="edit", username=self.creator, **kwargs)
 
+    @property
+    def global_namespace(self):
+        if "namespace" not in self.__dict__:
+            self.namespace = MappingProxyType(
+                {
+                    "__builtins__": MappingProxyType(
+                        {**builtins, "__import__": self._import}
+                    ),
+                    "fetch": self.fetch,
+                    "fetch_all": partial(self.fetch, func="fetch_all"),
+                    "send_email": app.send_email,
+                    "settings": app.settings,
+                    "encrypt": app.encrypt_password,
+                    "get_result": self.get_result,
+                    "log": self.log,
+                    "workflow": self.workflow,
+                    "placeholder": self.original.placeholder,
+                    "dict_to_string": app.str_dict,
+                }
+            )
+        return self.namespace
+
+    def get_payload_helpers(self, payload):
+        helpers = self.__dict__.get("payload_helpers")
+        if not helpers or helpers[0] is not payload:
+            get_var = partial(self.get_var, payload)
+            set_var = partial(self.payload_helper, payload)
+            helpers = self.payload_helpers = (payload, get_var, set_var)
+        return helpers[1:]
+
     def global_variables(_self, **locals):  # noqa: N805
         payload, device = locals.get("payload", {}), locals.get("device")
-        variables = locals
-        variables.update(payload.get("variables", {}))
-        if device and "devices" in payload.get("variables", {}):
-            variables.update(payload["variables"]["devices"].get(device.name, {}))
-        variables.update(
-            {
-                "__builtins__": {**builtins, "__import__": _self._import},
-                "fetch": _self.fetch,
-                "fetch_all": partial(_self.fetch, func="fetch_all"),
-                "send_email": app.send_email,
-                "settings": app.settings,
-                "devices": _self.target_devices,
-                "encrypt": app.encrypt_password,
-                "get_var": partial(_self.get_var, payload),
-                "get_result": _self.get_result,
-                "log": _self.log,
-                "workflow": _self.workflow,
-                "set_var": partial(_self.payload_helper, payload),
-                "parent_device": _self.parent_device or device,
-                "placeholder": _self.original.placeholder,
-                "dict_to_string": app.str_dict,
-            }
+        device_name, device_variables = getattr(device, "name", None), {}
+        with _self.payload_lock:
+            payload_variables = dict(payload.get("variables", {}))
+            if device and "devices" in payload_variables:
+                device_variables = dict(
+                    payload_variables["devices"].get(device_name, {})
+                )
+        namespace = _self.global_namespace
+        get_var, set_var = _self.get_payload_helpers(payload)
+        return Namespace(
+            ChainMap(
+                namespace,
+                _self.get_iteration_variables(device_name),
+                device_variables,
+                payload_variables,
+                locals,
+            ),
+            __builtins__=namespace["__builtins__"],
+            devices=_self.target_devices,
+            get_var=get_var,
+            set_var=set_var,
+            parent_device=_self.parent_device or device,
         )
+
+    def exec_variables(_self, **locals):  # noqa: N805
+        variables = _self.global_variables(**locals)
+        variables["__builtins__"] = dict(variables["__builtins__"])
         return variables
 
     def eval(_self, query, function="eval", **locals):  # noqa: N805
-        exec_variables = _self.global_variables(**locals)
-        results = builtins[function](query, exec_variables) if query else ""
-        return results, exec_variables
-
-    def sub(self, input, variables):
-
-        r = compile("{{(.*?)}}")
-
-        def replace(match):
-            return str(self.eval(match.group()[2:-2], **variables)[0])
+        if function == "exec":
+            exec_variables = _self.exec_variables(**locals)
+        else:
+            exec_variables = _self.global_variables(**locals)
+        if not query:
+            return "", exec_variables
+        code = app.compile_code(query, function)
+        return builtins[function](code, exec_variables), exec_variables
+
+    def sub(self, input, variables, cache=True):
+        compile_template = app.compile_template
+        if not cache:
+            compile_template = compile_template.__wrapped__
+        namespace = None
+
+        def render(input):
+            nonlocal namespace
+            template = compile_template(input)
+            if len(template) == 1:
+                return input
+            if namespace is None:
+                namespace = self.global_variables(**variables)
+            return "".join(
+                str(eval(segment, namespace)) if index % 2 and segment else segment
+                for index, segment in enumerate(template)
+            )
 
         def rec(input):
             if isinstance(input, str):
-                return r.sub(replace, input)
+                return render(input)
             elif isinstance(input, list):
                 return [rec(x) for x in input]
             elif isinstance(input, dict):
@@ -1242,6 +1952,11 @@ class Run(AbstractBase):
         if connection:
             self.log("info", "Using cached Netmiko connection", device)
             return self.update_netmiko_connection(connection)
+        driver = device.netmiko_driver if self.use_device_driver else self.driver
+        connection = self.get_pooled_connection("netmiko", device, driver)
+        if connection:
+            return self.update_netmiko_connection(connection)
+        credentials = self.get_credentials(device)
         self.log(
             "info",
             "OPENING Netmiko connection",
@@ -1249,7 +1964,6 @@ class Run(AbstractBase):
             change_log=False,
             logger="security",
         )
-        driver = device.netmiko_driver if self.use_device_driver else self.driver
         netmiko_connection = ConnectHandler(
             device_type=driver,
             ip=device.ip_address,
@@ -1259,7 +1973,7 @@ class Run(AbstractBase):
             global_delay_factor=self.global_delay_factor,
             session_log=BytesIO(),
             global_cmd_verify=False,
-            **self.get_credentials(device),
+            **credentials,
         )
         if self.enable_mode:
             netmiko_connection.enable()
@@ -1275,6 +1989,11 @@ class Run(AbstractBase):
         if connection:
             self.log("info", "Using cached Scrapli connection", device)
             return connection
+        driver = device.scrapli_driver if self.use_device_driver else self.driver
+        connection = self.get_pooled_connection("scrapli", device, driver)
+        if connection:
+            return connection
+        credentials = self.get_credentials(device)
         self.log(
             "info",
             "OPENING Scrapli connection",
@@ -1282,10 +2001,9 @@ class Run(AbstractBase):
             change_log=False,
             logger="security",
         )
-        credentials = self.get_credentials(device)
         connection = Scrapli(
             transport=self.transport,
-            platform=device.scrapli_driver if self.use_device_driver else self.driver,
+            platform=driver,
             host=device.ip_address,
             auth_username=credentials["username"],
             auth_password=credentials["password"],
@@ -1296,11 +2014,43 @@ class Run(AbstractBase):
         app.connections_cache["scrapli"][self.parent_runtime][device.name] = connection
         return connection
 
+    async def async_scrapli_connection(self, device):
+        cache = app.connections_cache["async_scrapli"][self.parent_runtime]
+        if device.name in cache and not self.start_new_connection:
+            self.log("info", "Using cached Scrapli connection", device)
+            return cache[device.name]
+        await self.async_disconnect(device.name)
+        self.log(
+            "info",
+            "OPENING Scrapli connection (asyncio)",
+            device,
+            change_log=False,
+            logger="security",
+        )
+        credentials = self.get_credentials(device)
+        connection = AsyncScrapli(
+            transport=self.transport,
+            platform=device.scrapli_driver if self.use_device_driver else self.driver,
+            host=device.ip_address,
+            auth_username=credentials["username"],
+            auth_password=credentials["password"],
+            auth_private_key=False,
+            auth_strict_key=False,
+        )
+        await connection.open()
+        cache[device.name] = connection
+        return connection
+
     def napalm_connection(self, device):
         connection = self.get_or_close_connection("napalm", device.name)
         if connection:
             self.log("info", "Using cached NAPALM connection", device)
             return connection
+        driver = device.napalm_driver if self.use_device_driver else self.driver
+        connection = self.get_pooled_connection("napalm", device, driver)
+        if connection:
+            return connection
+        credentials = self.get_credentials(device)
         self.log(
             "info",
             "OPENING Napalm connection",
@@ -1308,16 +2058,12 @@ class Run(AbstractBase):
             change_log=False,
             logger="security",
         )
-        credentials = self.get_credentials(device)
         optional_args = self.service.optional_args
         if not optional_args:
             optional_args = {}
         if "secret" not in optional_args:
             optional_args["secret"] = credentials.pop("secret")
-        driver = get_network_driver(
-            device.napalm_driver if self.use_device_driver else self.driver
-        )
-        napalm_connection = driver(
+        napalm_connection = get_network_driver(driver)(
             hostname=device.ip_address,
             timeout=self.timeout,
             optional_args=optional_args,
@@ -1335,30 +2081,49 @@ class Run(AbstractBase):
             return
         if self.start_new_connection:
             return self.disconnect(library, device, connection)
-        if library == "napalm":
-            if connection.is_alive():
-                return connection
+        if self.is_connection_alive(library, connection):
+            return connection
+        self.disconnect(library, device, connection)
+
+    @staticmethod
+    def is_connection_alive(library, connection):
+        try:
+            if library == "napalm":
+                return connection.is_alive()
+            elif library == "netmiko":
+                connection.find_prompt()
             else:
-                self.disconnect(library, device, connection)
-        else:
-            try:
-                if library == "netmiko":
-                    connection.find_prompt()
-                else:
-                    connection.get_prompt()
-                return connection
-            except Exception:
-                self.disconnect(library, device, connection)
+                connection.get_prompt()
+            return True
+        except Exception:
+            return False
 
     def get_connection(self, library, device):
         cache = app.connections_cache[library].get(self.parent_runtime, {})
         return cache.get(device)
 
-    def close_device_connection(self, device):
+    def get_pooled_connection(self, library, device, driver):
+        if not app.connection_pool_enabled:
+            return
+        key = (library, device.id, self.get_credentials_key(device), driver)
+        connection = None
+        if not self.start_new_connection:
+            connection = app.connection_pool_acquire(key)
+        if connection and not self.is_connection_alive(library, connection):
+            self.disconnect(library, device.name, connection)
+            connection = None
+        app.connection_pool_keys[library, self.parent_runtime, device.name] = key
+        if connection:
+            self.log("info", f"Using pooled {library} connection", device)
+            cache = app.connections_cache[library][self.parent_runtime]
+            cache[device.name] = connection
+        return connection
+
+    def close_device_connection(self, device, release=False):
         for library in ("netmiko", "napalm", "scrapli"):
             connection = self.get_connection(library, device)
             if connection:
-                self.disconnect(library, device, connection)
+                self.disconnect(library, device, connection, release)
 
     def close_remaining_connections(self):
         threads = []
@@ -1367,23 +2132,38 @@ class Run(AbstractBase):
             for device in devices:
                 connection = app.connections_cache[library][self.runtime][device]
                 thread = Thread(
-                    target=self.disconnect, args=(library, device, connection)
+                    target=self.disconnect, args=(library, device, connection, True)
                 )
                 thread.start()
                 threads.append(thread)
         for thread in threads:
             thread.join()
 
-    def disconnect(self, library, device, connection):
+    def disconnect(self, library, device, connection, release=False):
+        key = app.connection_pool_keys.pop((library, self.parent_runtime, device), None)
+        if release and key and app.connection_pool_release(key, connection):
+            app.connections_cache[library][self.parent_runtime].pop(device, None)
+            return self.log("info", f"Released {library} connection to pool", device)
         try:
             connection.disconnect() if library == "netmiko" else connection.close()
-            app.connections_cache[library][self.parent_runtime].pop(device)
+            app.connections_cache[library][self.parent_runtime].pop(device, None)
             self.log("info", f"Closed {library} connection", device)
         except Exception as exc:
             self.log(
                 "error", f"Error while closing {library} connection ({exc})", device
             )
 
+    async def async_disconnect(self, device):
+        cache = app.connections_cache["async_scrapli"][self.parent_runtime]
+        connection = cache.pop(device, None)
+        if not connection:
+            return
+        try:
+            await connection.close()
+            self.log("info", "Closed scrapli connection", device)
+        except Exception as exc:
+            self.log("error", f"Error while closing scrapli connection ({exc})", device)
+
     def enter_remote_device(self, connection, device):
         if not getattr(self, "jump_on_connect", False):
             return
@@ -1397,7 +2177,9 @@ class Run(AbstractBase):
                     self.sub(self.expect_username_prompt, locals()),
                     self.sub(self.jump_username, locals()),
                     self.sub(self.expect_password_prompt, locals()),
-                    self.sub(app.get_password(self.jump_password), locals()),
+                    self.sub(
+                        app.get_password(self.jump_password), locals(), cache=False
+                    ),
                     self.sub(self.expect_prompt, locals()),
                 ],
             )
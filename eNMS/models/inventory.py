@@ -99,21 +99,40 @@ class Device(Object):
                 )
         return cls
 
-    def get_credentials(self, credential_type="any", username=None):
-        if not username:
-            username = current_user.name
+    @staticmethod
+    def credentials_query(credential_type, username, *entities):
         pool_alias = aliased(models["pool"])
         query = (
-            db.session.query(models["credential"])
+            db.session.query(*entities, models["credential"])
+            .select_from(models["credential"])
             .join(models["pool"], models["credential"].user_pools)
             .join(models["user"], models["pool"].users)
             .join(pool_alias, models["credential"].device_pools)
             .join(models["device"], pool_alias.devices)
             .filter(models["user"].name == username)
-            .filter(models["device"].name == self.name)
         )
         if credential_type != "any":
             query = query.filter(models["credential"].role == credential_type)
+        return query
+
+    @classmethod
+    def get_bulk_credentials(cls, device_ids, credential_type="any", username=None):
+        credentials = {}
+        query = cls.credentials_query(
+            credential_type, username or current_user.name, models["device"].id
+        ).filter(models["device"].id.in_(device_ids))
+        for device_id, credential in query:
+            best_match = credentials.get(device_id)
+            if not best_match or credential.priority > best_match.priority:
+                credentials[device_id] = credential
+        return credentials
+
+    def get_credentials(self, credential_type="any", username=None):
+        if not username:
+            username = current_user.name
+        query = self.credentials_query(credential_type, username).filter(
+            models["device"].name == self.name
+        )
         credentials = max(query.all(), key=attrgetter("priority"), default=None)
         if not credentials:
             raise Exception(f"No matching credentials found for DEVICE '{self.name}'")
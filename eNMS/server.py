@@ -383,6 +383,12 @@ class Server(Flask):
                 result = db.delete(model, name=name)
                 return result
 
+        class GetArchive(Resource):
+            decorators = [self.auth.login_required, self.monitor_rest_request]
+
+            def get(self, model):
+                return app.get_archive(model, **request.args.to_dict())
+
         class GetConfiguration(Resource):
             decorators = [self.auth.login_required, self.monitor_rest_request]
 
@@ -398,6 +404,9 @@ class Server(Flask):
                     "run", service_name=name, runtime=runtime, allow_none=True
                 )
                 if not run:
+                    archived_result = app.get_archived_result(name, runtime)
+                    if archived_result:
+                        return archived_result
                     error_message = (
                         "There are no results or on-going services "
                         "for the requested service and runtime."
@@ -568,6 +577,7 @@ class Server(Flask):
         api.add_resource(GetConfiguration, "/rest/configuration/<string:name>")
         api.add_resource(Search, "/rest/search")
         api.add_resource(GetResult, "/rest/result/<string:name>/<string:runtime>")
+        api.add_resource(GetArchive, "/rest/archive/<string:model>")
         api.add_resource(Migrate, "/rest/migrate/<string:direction>")
         api.add_resource(Topology, "/rest/topology/<string:direction>")
         api.add_resource(Sink, "/rest/<path:path>")
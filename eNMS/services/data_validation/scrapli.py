@@ -4,7 +4,13 @@ from wtforms.widgets import TextArea
 from eNMS import app
 from eNMS.database import db
 from eNMS.forms import choices
-from eNMS.forms.fields import BooleanField, HiddenField, SelectField, StringField
+from eNMS.forms.fields import (
+    BooleanField,
+    HiddenField,
+    IntegerField,
+    SelectField,
+    StringField,
+)
 from eNMS.forms.automation import ConnectionForm
 from eNMS.models.automation import ConnectionService
 
@@ -20,23 +26,40 @@ class ScrapliService(ConnectionService):
     driver = db.Column(db.SmallString)
     transport = db.Column(db.SmallString, default="system")
     use_device_driver = db.Column(Boolean, default=True)
+    max_concurrent_sessions = db.Column(Integer, default=100)
 
     __mapper_args__ = {"polymorphic_identity": "scrapli_service"}
 
+    @property
+    def asynchronous_job(self):
+        return self.transport in ("asyncssh", "asynctelnet")
+
     def job(self, run, payload, device):
         commands = run.sub(run.commands, locals()).splitlines()
         function = "send_configs" if run.is_configuration else "send_commands"
         result = getattr(run.scrapli_connection(device), function)(commands).result
         return {"commands": commands, "result": result}
 
+    async def async_job(self, run, payload, device):
+        commands = run.sub(run.commands, locals()).splitlines()
+        function = "send_configs" if run.is_configuration else "send_commands"
+        connection = await run.async_scrapli_connection(device)
+        response = await getattr(connection, function)(commands)
+        return {"commands": commands, "result": response.result}
+
 
 class ScrapliForm(ConnectionForm):
     form_type = HiddenField(default="scrapli_service")
     commands = StringField(substitution=True, widget=TextArea(), render_kw={"rows": 5})
     is_configuration = BooleanField()
     driver = SelectField(choices=choices(app.SCRAPLI_DRIVERS))
-    transport = SelectField(choices=choices(("system", "paramiko", "ssh2")))
+    transport = SelectField(
+        choices=choices(("system", "paramiko", "ssh2", "asyncssh", "asynctelnet"))
+    )
     use_device_driver = BooleanField(default=True)
+    max_concurrent_sessions = IntegerField(
+        "Maximum number of concurrent sessions (asyncio transports)", default=100
+    )
     groups = {
         "Main Parameters": {
             "commands": [
@@ -45,6 +68,7 @@ class ScrapliForm(ConnectionForm):
                 "driver",
                 "transport",
                 "use_device_driver",
+                "max_concurrent_sessions",
             ],
             "default": "expanded",
         },
@@ -21,6 +21,7 @@ class RestCallService(Service):
 
     __tablename__ = "rest_call_service"
     pretty_name = "REST Call"
+    parallel_iteration = True
     id = db.Column(Integer, ForeignKey("service.id"), primary_key=True)
     call_type = db.Column(db.SmallString)
     rest_url = db.Column(db.LargeString)
@@ -81,3 +82,7 @@ class RestCallForm(ServiceForm):
     timeout = IntegerField(default=15)
     username = StringField()
     password = PasswordField()
+    parallel_iteration_values = BooleanField("Run iteration values in parallel")
+    max_parallel_iteration_values = IntegerField(
+        "Maximum number of parallel iteration values", default=5
+    )
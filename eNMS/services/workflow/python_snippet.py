@@ -4,7 +4,7 @@ from wtforms.widgets import TextArea
 
 from eNMS.database import db
 from eNMS.forms.automation import ServiceForm
-from eNMS.forms.fields import HiddenField, StringField
+from eNMS.forms.fields import BooleanField, HiddenField, IntegerField, StringField
 from eNMS.models.automation import Service
 
 
@@ -12,6 +12,7 @@ class PythonSnippetService(Service):
 
     __tablename__ = "python_snippet_service"
     pretty_name = "Python Snippet"
+    parallel_iteration = True
 
     id = db.Column(Integer, ForeignKey("service.id"), primary_key=True)
     source_code = db.Column(db.LargeString)
@@ -32,14 +33,8 @@ class PythonSnippetService(Service):
             if kwargs.get("exit"):
                 raise SystemExit()
 
-        globals = {
-            "results": results,
-            "save_result": save_result,
-            **run.global_variables(**locals()),
-        }
-
         try:
-            exec(code_object, globals)
+            exec(code_object, run.exec_variables(**locals()))
         except SystemExit:
             pass
         except Exception as exc:
@@ -74,3 +69,7 @@ result = {}
 results["success"] = True
 results["result"] = result""",
     )
+    parallel_iteration_values = BooleanField("Run iteration values in parallel")
+    max_parallel_iteration_values = IntegerField(
+        "Maximum number of parallel iteration values", default=5
+    )
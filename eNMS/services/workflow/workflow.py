@@ -1,13 +1,21 @@
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from sqlalchemy import Boolean, ForeignKey, Integer
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.schema import UniqueConstraint
 
 from eNMS import app
 from eNMS.database import db
+from eNMS.models import models
 from eNMS.models.base import AbstractBase
 from eNMS.forms.automation import ServiceForm
-from eNMS.forms.fields import BooleanField, HiddenField, InstanceField, SelectField
+from eNMS.forms.fields import (
+    BooleanField,
+    HiddenField,
+    InstanceField,
+    IntegerField,
+    SelectField,
+)
 from eNMS.models.automation import Service
 
 
@@ -18,6 +26,8 @@ class Workflow(Service):
     parent_type = "service"
     id = db.Column(Integer, ForeignKey("service.id"), primary_key=True)
     close_connection = db.Column(Boolean, default=False)
+    parallel_services = db.Column(Boolean, default=False)
+    max_parallel_services = db.Column(Integer, default=5)
     labels = db.Column(db.Dict, info={"log_change": False})
     services = relationship(
         "Service", secondary=db.service_workflow_table, back_populates="workflows"
@@ -104,56 +114,58 @@ class Workflow(Service):
     def deep_edges(self):
         return sum([w.edges for w in self.deep_services if w.type == "workflow"], [])
 
+    def compile_graph(self):
+        graph = {
+            "services": {service.id: service for service in self.services},
+            "destination": defaultdict(list),
+            "source": defaultdict(list),
+        }
+        edges = db.session.query(
+            WorkflowEdge.id,
+            WorkflowEdge.subtype,
+            WorkflowEdge.source_id,
+            WorkflowEdge.destination_id,
+        ).filter(WorkflowEdge.workflow_id == self.id)
+        endpoint_ids = set()
+        for edge_id, subtype, source_id, destination_id in edges:
+            graph["destination"][source_id, subtype].append((destination_id, edge_id))
+            graph["source"][destination_id, subtype].append((source_id, edge_id))
+            endpoint_ids |= {source_id, destination_id}
+        service, missing_ids = models["service"], endpoint_ids - set(graph["services"])
+        graph["endpoints"] = dict(graph["services"])
+        if missing_ids:
+            query = db.session.query(service).filter(service.id.in_(missing_ids))
+            graph["endpoints"].update((endpoint.id, endpoint) for endpoint in query)
+        return graph
+
     def job(self, run, payload, device=None):
-        number_of_runs = defaultdict(int)
-        start = db.fetch("service", scoped_name="Start")
-        end = db.fetch("service", scoped_name="End")
-        services = [db.fetch("service", id=id) for id in run.start_services]
+        number_of_runs, graph = defaultdict(int), self.compile_graph()
+        workflow_services = graph["services"]
+        scoped_names = {s.scoped_name: s for s in workflow_services.values()}
+        start, end = (
+            scoped_names.get(name) or db.fetch("service", scoped_name=name)
+            for name in ("Start", "End")
+        )
+        services = [
+            workflow_services.get(int(id)) or db.fetch("service", id=id)
+            for id in run.start_services
+        ]
         visited, targets, restart_run = set(), defaultdict(set), run.restart_run
         tracking_bfs = run.run_method == "per_service_with_workflow_targets"
         start_targets = [device] if device else run.target_devices
+        device_ids = {device.name: device.id for device in start_targets}
         for service in services:
             targets[service.name] |= {device.name for device in start_targets}
-        while services:
-            if run.stop:
-                return {"payload": payload, "success": False, "result": "Stopped"}
-            service = services.pop()
-            if number_of_runs[service.name] >= service.maximum_runs or any(
-                node not in visited
-                for node, _ in service.neighbors(self, "source", "prerequisite")
-            ):
-                continue
-            number_of_runs[service.name] += 1
-            visited.add(service)
-            if service in (start, end) or service.skip.get(self.name, False):
-                success = service.skip_value == "success"
-                results = {"result": "skipped", "success": success}
-                if tracking_bfs or device:
-                    results["summary"] = {
-                        "success": targets[service.name],
-                        "failure": [],
-                    }
-            else:
-                kwargs = {
-                    "service": run.placeholder.id
-                    if service.scoped_name == "Placeholder"
-                    else service.id,
-                    "workflow": self.id,
-                    "restart_run": restart_run,
-                    "parent": run,
-                    "parent_runtime": run.parent_runtime,
-                }
-                if tracking_bfs or device:
-                    kwargs["target_devices"] = [
-                        db.fetch("device", name=name).id
-                        for name in targets[service.name]
-                    ]
-                if run.parent_device_id:
-                    kwargs["parent_device"] = run.parent_device_id
-                service_run = db.factory("run", commit=True, **kwargs)
-                results = service_run.run(payload)
-                if not results:
-                    continue
+        width = self.max_parallel_services if self.parallel_services else 1
+        executor = ThreadPoolExecutor(max_workers=width) if width > 1 else None
+        running, waiting = {}, []
+        if executor:
+            db.session.commit()
+
+        def process_results(service, results):
+            visited.add(service.id)
+            if not results:
+                return
             status = "success" if results["success"] else "failure"
             summary = results.get("summary", {})
             if not tracking_bfs and not device:
@@ -163,32 +175,129 @@ class Workflow(Service):
                     continue
                 if tracking_bfs and not summary[edge_type]:
                     continue
-                for successor, edge in service.neighbors(
-                    self, "destination", edge_type
-                ):
+                for successor_id, edge_id in graph["destination"][
+                    service.id, edge_type
+                ]:
+                    successor = graph["endpoints"].get(successor_id)
+                    if not successor:
+                        continue
                     if tracking_bfs or device:
                         targets[successor.name] |= set(summary[edge_type])
                     services.append(successor)
                     if tracking_bfs or device:
                         run.write_state(
-                            f"edges/{edge.id}", len(summary[edge_type]), "increment"
+                            f"edges/{edge_id}", len(summary[edge_type]), "increment"
                         )
                     else:
-                        run.write_state(f"edges/{edge.id}", "DONE")
+                        run.write_state(f"edges/{edge_id}", "DONE")
+
+        try:
+            while services or running:
+                if run.stop:
+                    return {"payload": payload, "success": False, "result": "Stopped"}
+                if not services or len(running) == width:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        process_results(running.pop(future), future.result())
+                    services.extend(waiting)
+                    waiting.clear()
+                    continue
+                service = services.pop()
+                if number_of_runs[service.name] >= service.maximum_runs:
+                    continue
+                if any(
+                    source_id not in visited
+                    for source_id, _ in graph["source"][service.id, "prerequisite"]
+                ):
+                    if running:
+                        waiting.append(service)
+                    continue
+                number_of_runs[service.name] += 1
+                if service in (start, end) or service.skip.get(self.name, False):
+                    success = service.skip_value == "success"
+                    results = {"result": "skipped", "success": success}
+                    if tracking_bfs or device:
+                        results["summary"] = {
+                            "success": targets[service.name],
+                            "failure": [],
+                        }
+                    process_results(service, results)
+                    continue
+                kwargs = {
+                    "service": (
+                        run.placeholder.id
+                        if service.scoped_name == "Placeholder"
+                        else service.id
+                    ),
+                    "workflow": self.id,
+                    "parent_runtime": run.parent_runtime,
+                }
+                if tracking_bfs or device:
+                    missing_names = targets[service.name] - set(device_ids)
+                    if missing_names:
+                        device_ids.update(self.get_device_ids(missing_names))
+                    kwargs["target_devices"] = [
+                        device_ids[name] for name in targets[service.name]
+                    ]
+                if run.parent_device_id:
+                    kwargs["parent_device"] = run.parent_device_id
+                if executor:
+                    restart_run_id = getattr(restart_run, "id", None)
+                    future = executor.submit(
+                        self.run_service, run.id, restart_run_id, kwargs, payload
+                    )
+                    running[future] = service
+                else:
+                    service_run = self.create_run(
+                        parent=run, restart_run=restart_run, **kwargs
+                    )
+                    process_results(service, service_run.run(payload))
+        finally:
+            if executor:
+                executor.shutdown()
         if tracking_bfs or device:
             failed = list(targets[start.name] - targets[end.name])
             summary = {"success": list(targets[end.name]), "failure": failed}
             results = {"payload": payload, "success": not failed, "summary": summary}
         else:
-            results = {"payload": payload, "success": end in visited}
+            results = {"payload": payload, "success": end.id in visited}
         db.session.refresh(run)
         run.restart_run = restart_run
         return results
 
+    @staticmethod
+    def create_run(**kwargs):
+        target_ids = kwargs.pop("target_devices", None)
+        run = db.factory("run", commit=True, **kwargs)
+        if target_ids is not None:
+            run.target_devices = run.fetch_devices(target_ids)
+        return run
+
+    @staticmethod
+    def get_device_ids(names):
+        device = models["device"]
+        query = db.session.query(device.name, device.id)
+        return dict(query.filter(device.name.in_(names)))
+
+    def run_service(self, run_id, restart_run_id, kwargs, payload):
+        try:
+            kwargs["parent"] = db.fetch("run", id=run_id, rbac=None)
+            if restart_run_id:
+                kwargs["restart_run"] = db.fetch("run", id=restart_run_id, rbac=None)
+            results = self.create_run(**kwargs).run(payload)
+            db.session.commit()
+            return results
+        finally:
+            db.session.remove()
+
 
 class WorkflowForm(ServiceForm):
     form_type = HiddenField(default="workflow")
     close_connection = BooleanField(default=False)
+    parallel_services = BooleanField("Run independent services in parallel")
+    max_parallel_services = IntegerField(
+        "Maximum number of parallel services", default=5
+    )
     run_method = SelectField(
         "Run Method",
         choices=(
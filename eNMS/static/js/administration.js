@@ -154,6 +154,29 @@ function databaseDeletion() {
   });
 }
 
+function archiveResults() {
+  notify("Results Archival initiated...", "success", 5, true);
+  call({
+    url: "/archive_results",
+    form: "archive_results-form",
+    callback: function (result) {
+      const message = `${result.run || 0} runs and ${result.result || 0} results`;
+      notify(`Archived ${message}.`, "success", 5, true);
+      $("#archive_results").remove();
+    },
+  });
+}
+
+function compressLegacyResults() {
+  notify("Legacy Results Compression initiated...", "success", 5, true);
+  call({
+    url: "/compress_legacy_results",
+    callback: function (count) {
+      notify(`Compressed ${count} legacy results.`, "success", 5, true);
+    },
+  });
+}
+
 function resultLogDeletion() {
   notify("Log Deletion initiated...", "success", 5, true);
   call({
@@ -373,6 +396,8 @@ export function showCredentialPanel(id) {
 }
 
 configureNamespace("administration", [
+  archiveResults,
+  compressLegacyResults,
   createNewFolder,
   databaseDeletion,
   deleteFile,
@@ -422,15 +422,18 @@ function refreshLogs(service, runtime, editor, first, wasRefreshed, line) {
   call({
     url: `/get_service_logs/${service.id}/${runtime}/${line || 0}`,
     callback: function (result) {
-      if (!first && result.refresh && result.logs.length) {
+      if (first) {
+        editor.setValue(`Gathering logs for '${service.name}'...\n\n${result.logs}`);
+        editor.refresh();
+      } else if (result.logs.length) {
         // eslint-disable-next-line new-cap
         editor.replaceRange(`\n${result.logs}`, CodeMirror.Pos(editor.lineCount()));
         editor.setCursor(editor.lineCount(), 0);
-      } else if (first || !result.refresh) {
-        editor.setValue(`Gathering logs for '${service.name}'...\n\n${result.logs}`);
-        editor.refresh();
       }
-      if (first || result.refresh) {
+      if (result.more) {
+        const refreshed = wasRefreshed || result.refresh;
+        refreshLogs(service, runtime, editor, false, refreshed, result.line);
+      } else if (first || result.refresh) {
         setTimeout(
           () =>
             refreshLogs(service, runtime, editor, false, result.refresh, result.line),
@@ -1,3 +1,5 @@
+from base64 import b64encode
+
 from eNMS import app
 from eNMS.database import db
 
@@ -61,3 +63,31 @@ def test_user_management(user_client):
     user1 = db.fetch("user", name="user1")
     user_client.post("/delete_instance/user/{}".format(user1.id))
     assert len(db.fetch_all("user")) == number_of_users + 2
+
+
+def test_archive_results(user_client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.settings["paths"], "files", str(tmp_path))
+    service = db.factory(
+        "python_snippet_service",
+        name="archived_service",
+        scoped_name="archived_service",
+        source_code="results.update(success=True, result='archived')",
+        creator="admin",
+        run_method="once",
+        skip_value="success",
+        commit=True,
+    )
+    runtime = "2020-01-02 00:00:00.000000"
+    app.run(service.id, creator="admin", runtime=runtime)
+    url = f"/rest/result/archived_service/{runtime}"
+    headers = {"Authorization": f"Basic {b64encode(b'admin:admin').decode()}"}
+    result = user_client.get(url, headers=headers).json
+    assert result["status"] == "Completed"
+    assert result["result"]["result"] == "archived"
+    assert app.archive_results(days=1)["run"] == 1
+    assert not db.fetch("run", allow_none=True, runtime=runtime)
+    runs = app.get_archive("run", runtime, runtime, service_id=service.id)
+    assert [run["runtime"] for run in runs] == [runtime]
+    assert user_client.get(url, headers=headers).json == result
+    url = "/rest/result/archived_service/2020-01-03 00:00:00.000000"
+    assert "error" in user_client.get(url, headers=headers).json
@@ -0,0 +1,944 @@
+from asyncio import sleep as asyncio_sleep
+from collections import defaultdict
+from fakeredis import FakeRedis
+from multiprocessing import active_children
+from pickle import dumps as pickle_dumps
+from pytest import raises
+from sqlalchemy import LargeBinary, literal, type_coerce
+from threading import current_thread, Lock, main_thread, Thread
+from time import sleep
+from types import SimpleNamespace
+from zlib import decompress
+
+from eNMS import app
+from eNMS.database import db
+from eNMS.models import models
+
+
+def test_compile_template():
+    assert app.compile_template("show version") == ("show version",)
+    template = app.compile_template("interface {{name}} mtu {{ mtu + 100 }}")
+    assert len(template) == 5
+    assert template[0::2] == ("interface ", " mtu ", "")
+    namespace = {"name": "Gi0/1", "mtu": 1400}
+    assert [eval(segment, namespace) for segment in template[1::2]] == ["Gi0/1", 1500]
+    assert app.compile_template("{{}}") == ("", "", "")
+    assert app.compile_template("{{name}}") is app.compile_template("{{name}}")
+
+
+def test_compile_code(user_client):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    app.compile_code.cache_clear()
+    assert run.eval("  value + 1", value=1)[0] == 2
+    assert run.eval("  value + 1", value=2)[0] == 3
+    _, variables = run.eval("result = value * 2", function="exec", value=3)
+    assert variables["result"] == 6
+    cache_info = app.compile_code.cache_info()
+    assert (cache_info.hits, cache_info.misses, cache_info.currsize) == (1, 2, 2)
+    assert app.compile_code("value", "eval") is app.compile_code("value", "eval")
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_sub(user_client):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    assert run.sub(["{{ 1 + 1 }}", {"{{}}": "a{{'b'}}"}], {}) == ["2", {"": "ab"}]
+    cache_size = app.compile_template.cache_info().currsize
+    assert run.sub("secret-{{ 40 + 2 }}", {}, cache=False) == "secret-42"
+    assert app.compile_template.cache_info().currsize == cache_size
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_redis_buffer(monkeypatch):
+    monkeypatch.setattr(app, "redis_queue", FakeRedis(decode_responses=True))
+    monkeypatch.setattr(app, "redis_flush_loop", lambda: None)
+    monkeypatch.setitem(app.settings["automation"]["redis_buffer"], "size", 100)
+    runtime = "2020-01-01 00:00:00.000000"
+    for _ in range(3):
+        app.redis_buffer(runtime, "hincrby", f"{runtime}/state", "progress", 1)
+    app.redis_buffer(runtime, "hset", f"{runtime}/state", "status", "Running")
+    app.redis_buffer(runtime, "hset", f"{runtime}/state", "status", "Completed")
+    app.redis_buffer(runtime, "lpush", f"{runtime}/logs", "line 1")
+    app.redis_buffer(runtime, "lpush", f"{runtime}/logs", "line 2")
+    assert app.redis_buffers[runtime] == {
+        ("hash", f"{runtime}/state", "progress"): ["hincrby", 3],
+        ("hash", f"{runtime}/state", "status"): ["hset", "Completed"],
+        ("lpush", f"{runtime}/logs"): ["line 1", "line 2"],
+    }
+    assert not app.redis_queue.exists(f"{runtime}/state")
+    app.flush_redis_buffer(runtime)
+    assert runtime not in app.redis_buffers
+    assert app.redis_queue.hgetall(f"{runtime}/state") == {
+        "progress": "3",
+        "status": "Completed",
+    }
+    assert app.redis_queue.lrange(f"{runtime}/logs", 0, -1) == ["line 2", "line 1"]
+    monkeypatch.setitem(app.settings["automation"]["redis_buffer"], "size", 2)
+    app.redis_buffer(runtime, "hincrby", f"{runtime}/state", "progress", 1)
+    assert app.redis_queue.hget(f"{runtime}/state", "progress") == "3"
+    app.redis_buffer(runtime, "hincrby", f"{runtime}/state", "progress", 1)
+    assert app.redis_queue.hget(f"{runtime}/state", "progress") == "5"
+
+
+def test_state_append_order(user_client, monkeypatch):
+    monkeypatch.setattr(app, "redis_flush_loop", lambda: None)
+    service = db.fetch("service", scoped_name="Start")
+    for redis_queue in (None, FakeRedis(decode_responses=True)):
+        monkeypatch.setattr(app, "redis_queue", redis_queue)
+        run = db.factory(
+            "run", service=service.id, runtime=app.get_time(), path="1", commit=True
+        )
+        for value in ("a", "b", "c"):
+            run.write_state("devices", value, "append")
+        assert run.get_state()["1"]["devices"] == ["a", "b", "c"]
+        app.run_db.pop(run.parent_runtime, None)
+        db.session.delete(run)
+        db.session.commit()
+
+
+class GovernorRun:
+    def __init__(self, runtime):
+        self.parent_runtime, self.state, self.stop = runtime, {}, False
+
+    def write_state(self, path, value, method=None):
+        if method == "increment":
+            value += self.state.get(path, 0)
+        self.state[path] = value
+
+
+def test_redis_governor(monkeypatch):
+    redis, clock = FakeRedis(decode_responses=True), [1000.0]
+    monkeypatch.setattr(app, "redis_queue", redis)
+    monkeypatch.setattr("eNMS.controller.automation.time", lambda: clock[0])
+    monkeypatch.setattr(app, "governor_renew_loop", lambda: None)
+    for property, value in (
+        ("governor_jobs", defaultdict(int)),
+        ("governor_leases", {}),
+        ("governor_queue", []),
+        ("governor_sessions", defaultdict(int)),
+    ):
+        monkeypatch.setattr(app, property, value)
+    governor = {"active": True, "max_jobs": 2, "max_sessions_per_device": 1}
+    for key, value in {**governor, "redis_lease_time": 30}.items():
+        monkeypatch.setitem(app.settings["automation"]["governor"], key, value)
+    devices = [SimpleNamespace(id=id) for id in range(4)]
+    run_a, run_b = GovernorRun("run_a"), GovernorRun("run_b")
+    a1, a2 = (app.governor_acquire(run_a, device) for device in devices[:2])
+    assert a1["cluster"] and a2["cluster"]
+    assert dict(redis.zrange("governor/jobs", 0, -1, withscores=True)) == {
+        a1["lease"]: 1030.0,
+        a2["lease"]: 1030.0,
+    }
+    assert redis.zrange("governor/device/0", 0, -1) == [a1["lease"]]
+    a3 = app.governor_enqueue(run_a, devices[2])
+    b1, b2 = (app.governor_enqueue(run_b, device) for device in devices[2:])
+    assert not any(ticket["granted"].is_set() for ticket in (a3, b1, b2))
+    assert run_a.state["governor/queued"] == 1 and run_b.state["governor/queued"] == 2
+    app.governor_release(a1)
+    assert b1["granted"].is_set() and not a3["granted"].is_set()
+    assert a1["lease"] not in app.governor_leases
+    assert redis.zrange("governor/device/0", 0, -1) == []
+    assert not app.governor_waiting(run_b, b1) and run_b.state["governor/queued"] == 1
+    clock[0] = 1020.0
+    app.governor_renew()
+    assert redis.zscore("governor/jobs", a2["lease"]) == 1050.0
+    assert redis.zscore("governor/device/2", b1["lease"]) == 1050.0
+    app.governor_release(a2)
+    assert b2["granted"].is_set() and not a3["granted"].is_set()
+    redis.zadd("governor/jobs", {"other_node": 1060.0})
+    app.governor_release(b1)
+    assert app.governor_waiting(run_a, a3)
+    clock[0] = 1040.0
+    app.governor_renew()
+    assert app.governor_waiting(run_a, a3)
+    clock[0] = 1061.0
+    assert not app.governor_waiting(run_a, a3) and a3["cluster"]
+    assert run_a.state["governor/queued"] == 0
+    assert set(redis.zrange("governor/jobs", 0, -1)) == {a3["lease"], b2["lease"]}
+    for ticket in (a3, b2):
+        app.governor_release(ticket)
+    assert not redis.zcard("governor/jobs") and not app.governor_leases
+    assert not app.governor_jobs and not app.governor_sessions
+
+
+def test_service_logs(user_client, monkeypatch):
+    service = db.fetch_all("service")[0].id
+    runtime, legacy_runtime = "2020-01-01 00:00:00.000001", "2020-01-01 00:00:00.000002"
+    for sequence, first_line, lines in ((0, 0, 3), (1, 3, 3), (2, 6, 1)):
+        content = "\n".join(f"line {first_line + index}" for index in range(lines))
+        db.factory(
+            "service_log",
+            service=service,
+            runtime=runtime,
+            sequence=sequence,
+            first_line=first_line,
+            line_count=lines,
+            content=content,
+        )
+    db.factory(
+        "service_log",
+        service=service,
+        runtime=legacy_runtime,
+        content="line 0\nline 1\nline 2",
+    )
+    db.session.commit()
+    page = app.get_service_logs(service, runtime, 0, 4)
+    assert page["logs"] == "line 0\nline 1\nline 2\nline 3"
+    assert (page["more"], page["line"], page["total"]) == (True, 4, 7)
+    assert not page["refresh"]
+    page = app.get_service_logs(service, runtime, page["line"], 4)
+    assert page["logs"] == "line 4\nline 5\nline 6"
+    assert (page["more"], page["line"]) == (False, 7)
+    assert app.get_service_logs(service, runtime, -2)["logs"] == "line 5\nline 6"
+    page = app.get_service_logs(service, legacy_runtime, 1, 1)
+    assert page["logs"] == "line 1"
+    assert (page["more"], page["line"], page["total"]) == (True, 2, 3)
+    assert app.get_service_logs(service, legacy_runtime, -1)["logs"] == "line 2"
+    live_runtime = "2020-01-01 00:00:00.000003"
+    monkeypatch.setattr(app, "redis_flush_loop", lambda: None)
+    for redis_queue in (None, FakeRedis(decode_responses=True)):
+        monkeypatch.setattr(app, "redis_queue", redis_queue)
+        app.log_queue(live_runtime, service, "line 0")
+        app.log_queue(live_runtime, service, "line 1\nline 2")
+        page = app.get_service_logs(service, live_runtime, 1, 1)
+        assert page["logs"] == "line 1" and page["refresh"]
+        assert (page["more"], page["line"], page["total"]) == (True, 2, 3)
+        page = app.get_service_logs(service, live_runtime, page["line"])
+        assert (page["logs"], page["more"], page["line"]) == ("line 2", False, 3)
+        page = app.get_service_logs(service, live_runtime, -2)
+        assert page["logs"] == "line 1\nline 2"
+        app.run_logs.pop(live_runtime)
+    log = models["service_log"]
+    db.session.query(log).filter(log.runtime.in_((runtime, legacy_runtime))).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+class PooledConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_pool(user_client, monkeypatch):
+    settings = app.settings["automation"]["connection_pool"]
+    for key, value in {
+        "active": True,
+        "idle_timeout": 300,
+        "reap_interval": 0.01,
+    }.items():
+        monkeypatch.setitem(settings, key, value)
+    for property in ("connection_pool", "connection_pool_keys"):
+        monkeypatch.setattr(app, property, {})
+    monkeypatch.setattr(app, "connection_pool_reaper", None)
+    monkeypatch.setattr(models["run"], "is_connection_alive", lambda *_: True)
+    device = db.fetch_all("device")[0]
+    service = db.factory(
+        "scrapli_service",
+        name="connection_pool",
+        scoped_name="connection_pool",
+        creator="admin",
+        commit=True,
+    )
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    credentials = {"id": 1, "name": "pooled", "username": "admin", "password": "*"}
+    app.run_credentials[run.parent_runtime] = {"any": {device.id: credentials}}
+    cache = app.connections_cache["scrapli"][run.parent_runtime]
+    driver = device.scrapli_driver
+    assert run.get_pooled_connection("scrapli", device, driver) is None
+    connection = cache[device.name] = PooledConnection()
+    run.close_device_connection(device.name, release=True)
+    assert device.name not in cache and len(app.connection_pool) == 1
+    monkeypatch.setattr(models["run"], "get_credentials", None)
+    assert run.scrapli_connection(device) is connection
+    assert cache[device.name] is connection and not app.connection_pool
+    run.close_device_connection(device.name, release=True)
+    assert run.get_pooled_connection("scrapli", device, "other_driver") is None
+    assert not connection.closed and len(app.connection_pool) == 1
+    monkeypatch.setitem(settings, "idle_timeout", 0)
+    for _ in range(100):
+        if connection.closed:
+            break
+        sleep(0.01)
+    assert connection.closed and not app.connection_pool
+    app.run_credentials.pop(run.parent_runtime)
+    app.connections_cache["scrapli"].pop(run.parent_runtime)
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_compressed_json_type(user_client):
+    column_type, value = db.CompressedJSONType(), {"success": True, "result": [1, "a"]}
+    stored = column_type.process_bind_param(value, None)
+    assert decompress(stored).startswith(b"{")
+    assert column_type.process_result_value(stored, None) == value
+    assert column_type.process_result_value(pickle_dumps(value), None) == value
+    assert column_type.process_result_value(None, None) is None
+    runtime, result = "2020-01-01 00:00:00.000004", models["result"]
+    db.session.bulk_insert_mappings(
+        result,
+        [
+            {"result": {"index": index}, "runtime": runtime, "parent_runtime": runtime}
+            for index in range(3)
+        ],
+    )
+    query = db.session.query(result.id).filter(result.parent_runtime == runtime)
+    ids = sorted(id for id, in query)
+    for id in ids[:2]:
+        db.session.execute(
+            result.__table__.update()
+            .where(result.id == id)
+            .values(result=literal(pickle_dumps({"index": id}), LargeBinary))
+        )
+    db.session.commit()
+    assert db.fetch("result", id=ids[0]).result == {"index": ids[0]}
+    assert app.compress_legacy_results() == 2
+    assert app.compress_legacy_results() == 0
+    db.session.expire_all()
+    column = type_coerce(result.__table__.c.result, LargeBinary)
+    for (stored,) in db.session.query(column).filter(result.id.in_(ids)):
+        assert stored[:1] == b"x"
+    assert db.fetch("result", id=ids[1]).result == {"index": ids[1]}
+    assert db.fetch("result", id=ids[2]).result == {"index": 2}
+    query.delete(synchronize_session=False)
+    db.session.commit()
+
+
+def test_compressed_run_state(user_client):
+    service, state = db.fetch("service", scoped_name="Start"), {"status": "Running"}
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    run.state = state
+    db.session.commit()
+    table, run_id = models["run"].__table__, run.id
+    column = type_coerce(table.c.state, LargeBinary)
+    query = db.session.query(column).filter(table.c.id == run_id)
+    assert query.scalar()[:1] == b"x"
+    db.session.execute(
+        table.update()
+        .where(table.c.id == run_id)
+        .values(state=literal(pickle_dumps(state), LargeBinary))
+    )
+    db.session.commit()
+    db.session.expire_all()
+    assert db.fetch("run", id=run_id).state == state
+    assert app.compress_legacy_results() == 1
+    assert query.scalar()[:1] == b"x"
+    db.delete("run", id=run_id)
+    db.session.commit()
+
+
+def test_compute_devices_from_query(user_client):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    devices = {device.name: device.id for device in db.fetch_all("device")}
+    device_ids = run.compute_devices_from_query("['Washington', 'Austin']", "name")
+    assert device_ids == {devices["Washington"], devices["Austin"]}
+    assert run.compute_devices_from_query("'Austin'", "name") == {devices["Austin"]}
+    assert run.compute_devices_from_query("[]", "name") == set()
+    with raises(Exception, match="invalid targets: Nowhere, 404$"):
+        run.compute_devices_from_query("['Austin', 'Nowhere', 404]", "name")
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_target_rbac(user_client):
+    devices = db.fetch_all("device")[:4]
+    user = db.factory("user", name="target_user", is_admin=False, commit=True)
+    pools = [
+        db.factory("pool", name=name, manually_defined=True, commit=True)
+        for name in ("rbac_targets", "rbac_users")
+    ]
+    pools[0].devices, pools[1].users = devices[:2], [user]
+    db.factory(
+        "access",
+        name="target_access",
+        access_type="target",
+        access_pools=[pools[0].id],
+        user_pools=[pools[1].id],
+        commit=True,
+    )
+    allowed_targets = set(db.query("device", rbac="target", username=user.name))
+    unauthorized = sorted(device.name for device in set(devices) - allowed_targets)
+    assert len(unauthorized) == 2
+    service = db.factory(
+        "python_snippet_service",
+        name="target_rbac",
+        scoped_name="target_rbac",
+        source_code="results['success'] = True",
+        creator=user.name,
+        target_devices=[device.id for device in devices],
+        commit=True,
+    )
+    result = app.run(service.id, creator=user.name, runtime=app.get_time())
+    assert not result["success"] and "Error 403" in result["result"]
+    assert sorted(result["result"].split(": ")[-1].split(", ")) == unauthorized
+    service.target_devices = devices[:2]
+    db.session.commit()
+    assert app.run(service.id, creator=user.name, runtime=app.get_time())["success"]
+
+
+def test_compile_graph(user_client):
+    workflows = [workflow for workflow in db.fetch_all("workflow") if workflow.edges]
+    assert workflows
+    for workflow in workflows:
+        graph = workflow.compile_graph()
+        services = {service.id: service for service in workflow.services}
+        assert graph["services"] == services
+        for edge in workflow.edges:
+            destinations = graph["destination"][edge.source_id, edge.subtype]
+            assert (edge.destination_id, edge.id) in destinations
+            sources = graph["source"][edge.destination_id, edge.subtype]
+            assert (edge.source_id, edge.id) in sources
+        for direction in ("destination", "source"):
+            edges = sum(map(len, graph[direction].values()))
+            assert edges == len(workflow.edges)
+
+
+def test_compile_graph_orphan_edge(user_client):
+    def snippet(name):
+        return db.factory(
+            "python_snippet_service",
+            name=name,
+            scoped_name=name,
+            source_code="results['success'] = True",
+            creator="admin",
+            commit=True,
+        )
+
+    workflow = db.factory(
+        "workflow",
+        name="orphan_edge",
+        scoped_name="orphan_edge",
+        run_method="per_service_with_service_targets",
+        skip_value="success",
+        commit=True,
+    )
+    service, orphan = snippet("orphan_edge_a"), snippet("orphan_edge_orphan")
+    workflow.services.append(service)
+    start, end = (db.fetch("service", scoped_name=name) for name in ("Start", "End"))
+    for source, destination in ((start, service), (service, end), (service, orphan)):
+        db.factory(
+            "workflow_edge",
+            name=f"orphan_edge {source.id}-{destination.id}",
+            workflow=workflow.id,
+            subtype="success",
+            source=source.id,
+            destination=destination.id,
+        )
+    db.session.commit()
+    graph = workflow.compile_graph()
+    assert orphan.id not in graph["services"]
+    assert graph["endpoints"][orphan.id] == orphan
+    assert (orphan.id, workflow.edges[-1].id) in graph["destination"][
+        service.id, "success"
+    ]
+    assert app.run(workflow.id, creator="admin", runtime=app.get_time())["success"]
+
+
+def test_process_mode_workflow(user_client):
+    devices = [device.id for device in db.fetch_all("device")[:2]]
+    service = db.factory(
+        "python_snippet_service",
+        name="process_workflow_a",
+        scoped_name="process_workflow_a",
+        source_code="log('info', 'inner log')\nresults['success'] = True",
+        creator="admin",
+        skip_value="success",
+        commit=True,
+    )
+    workflow = db.factory(
+        "workflow",
+        name="process_workflow",
+        scoped_name="process_workflow",
+        run_method="per_device",
+        multiprocessing=True,
+        multiprocessing_mode="process",
+        target_devices=devices,
+        skip_value="success",
+        commit=True,
+    )
+    workflow.services.append(service)
+    start, end = (db.fetch("service", scoped_name=name) for name in ("Start", "End"))
+    for source, destination in ((start, service), (service, end)):
+        db.factory(
+            "workflow_edge",
+            name=f"process_workflow {source.id}-{destination.id}",
+            workflow=workflow.id,
+            subtype="success",
+            source=source.id,
+            destination=destination.id,
+        )
+    db.session.commit()
+    runtime = app.run(workflow.id, creator="admin", runtime=app.get_time())["runtime"]
+    logs = app.get_service_logs(workflow.id, runtime, 0)["logs"]
+    assert "using threads" in logs and "pool of 2 threads" in logs
+    assert app.get_service_logs(service.id, runtime, 0)["logs"].count("inner log") == 2
+    assert len(db.fetch("run", runtime=runtime).results) == 3
+
+
+def test_process_mode_stop(user_client):
+    devices = [device.id for device in db.fetch_all("device")[:2]]
+    service = db.factory(
+        "python_snippet_service",
+        name="process_stop",
+        scoped_name="process_stop",
+        source_code=(
+            "from time import sleep\n"
+            "for _ in range(100):\n"
+            "    if run.stop:\n"
+            "        break\n"
+            "    sleep(0.05)\n"
+            "results.update(success=True, stopped=run.stop)"
+        ),
+        creator="admin",
+        multiprocessing=True,
+        multiprocessing_mode="process",
+        target_devices=devices,
+        skip_value="success",
+        commit=True,
+    )
+    runtime = app.get_time()
+    thread = Thread(target=app.run, args=(service.id,), kwargs={"runtime": runtime})
+    thread.start()
+    for _ in range(100):
+        if len(active_children()) == 2:
+            break
+        thread.join(0.05)
+    thread.join(0.5)
+    assert app.stop_workflow(runtime)
+    thread.join(10)
+    assert not thread.is_alive()
+    db.session.expire_all()
+    run = db.fetch("run", runtime=runtime)
+    assert "pool of 2 processes" in app.get_service_logs(service.id, runtime, 0)["logs"]
+    assert run.status == "Aborted" and runtime not in app.run_stop_events
+    device_results = [result for result in run.results if result.device_id]
+    assert len(device_results) == 2
+    assert all(result.result["stopped"] for result in device_results)
+
+
+def test_async_device_run(user_client, monkeypatch):
+    devices = db.fetch_all("device")[:4]
+    service = db.factory(
+        "scrapli_service",
+        name="async_run",
+        scoped_name="async_run",
+        creator="admin",
+        transport="asyncssh",
+        max_concurrent_sessions=2,
+        postprocessing="results['attempt'] = [total_retries, args[0].name]",
+        postprocessing_mode="always",
+        target_devices=[device.id for device in devices],
+        skip_value="success",
+        commit=True,
+    )
+    sessions, concurrency = set(), []
+
+    async def async_job(self, run, payload, device):
+        sessions.add(device.name)
+        concurrency.append(len(sessions))
+        await asyncio_sleep(0.05)
+        sessions.remove(device.name)
+        return {"result": device.name}
+
+    monkeypatch.setattr(models["scrapli_service"], "async_job", async_job)
+    runtime = app.run(service.id, creator="admin", runtime=app.get_time())["runtime"]
+    logs = app.get_service_logs(service.id, runtime, 0)["logs"]
+    assert "Starting an event loop for 4 devices (2 concurrent sessions)" in logs
+    assert len(concurrency) == 4 and max(concurrency) == 2
+    run = db.fetch("run", runtime=runtime)
+    device_results = {
+        result.device.name: result.result for result in run.results if result.device_id
+    }
+    assert len(device_results) == 4
+    for name, result in device_results.items():
+        assert result["success"] and result["result"] == name
+        assert result["attempt"] == [1, name]
+
+
+def test_workflow_target_ids(user_client, monkeypatch):
+    devices = db.fetch_all("device")[:2]
+    services = [
+        db.factory(
+            "python_snippet_service",
+            name=f"target_ids_{index}",
+            scoped_name=f"target_ids_{index}",
+            source_code="results['success'] = True",
+            creator="admin",
+            commit=True,
+        )
+        for index in range(2)
+    ]
+    workflow = db.factory(
+        "workflow",
+        name="target_ids",
+        scoped_name="target_ids",
+        run_method="per_service_with_workflow_targets",
+        target_devices=[device.id for device in devices],
+        skip_value="success",
+        commit=True,
+    )
+    workflow.services.extend(services)
+    start, end = (db.fetch("service", scoped_name=name) for name in ("Start", "End"))
+    path = [start, *services, end]
+    for source, destination in zip(path, path[1:]):
+        db.factory(
+            "workflow_edge",
+            name=f"target_ids {source.id}-{destination.id}",
+            workflow=workflow.id,
+            subtype="success",
+            source=source.id,
+            destination=destination.id,
+        )
+    db.session.commit()
+    fetch, lookups = db.fetch, []
+
+    def fetch_device(model, *args, **kwargs):
+        if model == "device" and "name" in kwargs:
+            lookups.append(kwargs["name"])
+        return fetch(model, *args, **kwargs)
+
+    monkeypatch.setattr(db, "fetch", fetch_device)
+    monkeypatch.setattr(models["workflow"], "get_device_ids", None)
+    runtime = app.run(workflow.id, creator="admin", runtime=app.get_time())["runtime"]
+    assert not lookups
+    for service in services:
+        run = db.fetch("run", parent_runtime=runtime, service_id=service.id)
+        assert set(run.target_devices) == set(devices)
+        assert len(run.results) == 3 and run.status == "Completed"
+
+
+def test_run_credentials(user_client, monkeypatch):
+    devices, device_model = db.fetch_all("device")[:2], models["device"]
+    get_bulk_credentials, calls = device_model.get_bulk_credentials, []
+
+    def bulk_credentials(*args, **kwargs):
+        calls.append(args)
+        return get_bulk_credentials(*args, **kwargs)
+
+    monkeypatch.setattr(device_model, "get_bulk_credentials", bulk_credentials)
+    service = db.factory(
+        "python_snippet_service",
+        name="run_credentials",
+        scoped_name="run_credentials",
+        source_code=(
+            "credentials = run.get_device_credentials(device)\n"
+            "results.update(success=True, result=credentials['username'])"
+        ),
+        creator="admin",
+        target_devices=[device.id for device in devices],
+        commit=True,
+    )
+    runtime = app.run(service.id, creator="admin", runtime=app.get_time())["runtime"]
+    run = db.fetch("run", runtime=runtime)
+    assert run.status == "Completed"
+    device_results = [result.result for result in run.results if result.device_id]
+    assert len(device_results) == 2
+    assert all(result["success"] and result["result"] for result in device_results)
+    assert len(calls) == 1 and runtime not in app.run_credentials
+
+
+def test_parallel_device_iteration(user_client):
+    devices = db.fetch_all("device")[:3]
+    source_code = f"results['success'] = device.name != '{devices[1].name}'"
+    start, end = (db.fetch("service", scoped_name=name) for name in ("Start", "End"))
+    outcomes = []
+    for multiprocessing in (False, True):
+        name = f"device_iteration_{multiprocessing}"
+        service = db.factory(
+            "python_snippet_service",
+            name=name,
+            scoped_name=name,
+            source_code=source_code,
+            iteration_devices="[device.name]",
+            iteration_devices_property="name",
+            multiprocessing=multiprocessing,
+            creator="admin",
+            commit=True,
+        )
+        workflow = db.factory(
+            "workflow",
+            name=f"{name}_workflow",
+            scoped_name=f"{name}_workflow",
+            run_method="per_service_with_workflow_targets",
+            target_devices=[device.id for device in devices],
+            commit=True,
+        )
+        workflow.services.append(service)
+        for source, destination in ((start, service), (service, end)):
+            db.factory(
+                "workflow_edge",
+                name=f"{name} {source.id}-{destination.id}",
+                workflow=workflow.id,
+                subtype="success",
+                source=source.id,
+                destination=destination.id,
+            )
+        db.session.commit()
+        runtime = app.get_time()
+        app.run(workflow.id, creator="admin", runtime=runtime)
+        logs = app.get_service_logs(service.id, runtime, 0)["logs"]
+        assert ("pool of 3 threads for device iteration" in logs) == multiprocessing
+        results = db.query("result").filter_by(
+            parent_runtime=runtime, service_id=service.id
+        )
+        summary = next(result.result for result in results if not result.device_id)
+        outcomes.append(
+            (
+                {key: sorted(value) for key, value in summary["summary"].items()},
+                sorted(
+                    (result.device.name, result.result["success"])
+                    for result in results
+                    if result.device_id
+                ),
+            )
+        )
+    assert outcomes[0] == outcomes[1]
+    assert outcomes[0][0]["failure"] == [devices[1].name]
+    assert len(outcomes[0][1]) == 3
+
+
+def test_results_payload_lock(user_client):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    lock = app.run_payload_locks[run.parent_runtime] = Lock()
+    results = {"payload": {"variables": {"name": "value"}}, "success": True}
+    with lock:
+        thread = Thread(target=run.make_results_json_compliant, args=(results,))
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+    thread.join(5)
+    assert not thread.is_alive()
+    with lock:
+        assert run.make_results_json_compliant({"success": True}) == {"success": True}
+    app.run_payload_locks.pop(run.parent_runtime)
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_result_index(user_client, monkeypatch):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    devices = {device.name: device.id for device in db.fetch_all("device")}
+    db.session.bulk_insert_mappings(
+        models["result"],
+        [
+            {
+                "result": {"device": "Austin", "source": "database"},
+                "runtime": run.runtime,
+                "parent_runtime": run.parent_runtime,
+                "run_id": run.id,
+                "service_id": service.id,
+                "device_id": devices["Austin"],
+            }
+        ],
+    )
+    db.session.commit()
+    monkeypatch.setitem(app.settings["automation"], "result_index_size", 4)
+    index = app.run_result_index[run.parent_runtime] = {}
+    for device in ("Austin", "Washington", "Jackson"):
+        run.index_result(device, {"device": device})
+    assert len(index) == 4 and ("name", "Start", "Austin") not in index
+    assert run.get_result("Start", "Jackson") == {"device": "Jackson"}
+    assert run.get_result("Start", "Austin")["source"] == "database"
+    app.run_result_index.pop(run.parent_runtime)
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_result_flush_interval(user_client, monkeypatch):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    device, runtime = db.fetch_all("device")[0], run.runtime
+    monkeypatch.setitem(app.settings["automation"], "result_batch_size", 100)
+    monkeypatch.setitem(app.settings["automation"], "result_flush_interval", 60)
+    results = {"success": True, "runtime": runtime, "duration": "0:00:00"}
+    run.buffer_result(results, device)
+    assert len(app.run_results[runtime]) == 1
+    run.buffer_result(results, device)
+    assert len(app.run_results[runtime]) == 2 and not run.results
+    app.run_results_flush_times[runtime] -= 60
+    run.buffer_result(results, device)
+    assert runtime not in app.run_results and len(run.results) == 3
+    app.run_results_flush_times.pop(runtime)
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_thread_mode_device_updates(user_client):
+    devices = db.fetch_all("device")[:2]
+    service = db.factory(
+        "python_snippet_service",
+        name="thread_device_update",
+        scoped_name="thread_device_update",
+        source_code=(
+            "device.description = f'updated {device.name}'\n"
+            "results['success'] = len(devices) == 2"
+        ),
+        creator="admin",
+        run_method="per_device",
+        multiprocessing=True,
+        target_devices=[device.id for device in devices],
+        commit=True,
+    )
+    for device in devices:
+        device.description = ""
+    db.session.commit()
+    assert app.run(service.id, creator="admin", runtime=app.get_time())["success"]
+    db.session.expire_all()
+    for device in devices:
+        assert device.description == f"updated {device.name}"
+
+
+def test_parallel_iteration_device_updates(user_client):
+    device = db.fetch_all("device")[0]
+    service = db.factory(
+        "python_snippet_service",
+        name="parallel_iteration_update",
+        scoped_name="parallel_iteration_update",
+        source_code=(
+            "if iteration_value == 'b':\n"
+            "    device.description = f'updated {device.name}'\n"
+            "results['success'] = True"
+        ),
+        creator="admin",
+        iteration_values="['a', 'b']",
+        parallel_iteration_values=True,
+        target_devices=[device.id],
+        commit=True,
+    )
+    device.description = ""
+    db.session.commit()
+    assert app.run(service.id, creator="admin", runtime=app.get_time())["success"]
+    db.session.expire_all()
+    assert device.description == f"updated {device.name}"
+
+
+def test_global_variables(user_client):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    payload = {"variables": {"name": "payload", "log": "payload"}}
+    variables = run.global_variables(payload=payload, name="local", other="local")
+    assert (variables["name"], variables["other"]) == ("payload", "local")
+    assert variables["log"] == run.log and "get_var" in variables
+    query = "[n for n in (name, other) if n != other]"
+    assert run.eval(query, payload=payload, other="local")[0] == ["payload"]
+    assert run.global_variables(payload=payload)["set_var"] is variables["set_var"]
+    run.eval("__builtins__['len'] = None", function="exec", payload=payload)
+    assert run.eval("len(name)", payload=payload)[0] == 7
+    with raises(ImportError, match="restricted"):
+        run.eval("import os", function="exec", payload=payload)
+    _, exec_variables = run.eval("retries = 3", function="exec", retries=1)
+    assert exec_variables.get("retries") == 3
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_parallel_iteration_in_threads(user_client, monkeypatch):
+    devices = db.fetch_all("device")[:2]
+    service = db.factory(
+        "python_snippet_service",
+        name="parallel_iteration_threads",
+        scoped_name="parallel_iteration_threads",
+        source_code=(
+            "if iteration_value == 'b':\n"
+            "    device.description = f'updated {device.name}'\n"
+            "results['success'] = True"
+        ),
+        creator="admin",
+        run_method="per_device",
+        multiprocessing=True,
+        iteration_values="['a', 'b']",
+        parallel_iteration_values=True,
+        target_devices=[device.id for device in devices],
+        commit=True,
+    )
+    for device in devices:
+        device.description = ""
+    db.session.commit()
+    commit, commit_threads = db.session.commit, set()
+
+    def record_commit():
+        commit_threads.add(current_thread())
+        commit()
+
+    monkeypatch.setattr(db.session, "commit", record_commit)
+    assert app.run(service.id, creator="admin", runtime=app.get_time())["success"]
+    assert commit_threads == {main_thread()}
+    db.session.expire_all()
+    for device in devices:
+        assert device.description == f"updated {device.name}"
+
+
+def test_notification_device_results(user_client, monkeypatch):
+    service = db.fetch("service", scoped_name="Start")
+    run = db.factory("run", service=service.id, runtime=app.get_time(), commit=True)
+    austin, washington, jackson = (
+        db.fetch("device", name=name) for name in ("Austin", "Washington", "Jackson")
+    )
+    run.target_devices = [austin, washington]
+    db.session.commit()
+    db.session.bulk_insert_mappings(
+        models["result"],
+        [
+            {
+                "result": {"index": index},
+                "runtime": run.runtime,
+                "parent_runtime": run.parent_runtime,
+                "run_id": run.id,
+                "service_id": service.id,
+                "device_id": device.id,
+            }
+            for index, device in enumerate((austin, washington, austin, jackson))
+        ],
+    )
+    db.session.commit()
+    assert dict(run.get_device_results()) == {
+        "Austin": {"index": 0},
+        "Washington": {"index": 1},
+    }
+    attachments = []
+
+    def send_email(*args, file_path=None, **kwargs):
+        with open(file_path) as file:
+            attachments.append(file.read())
+
+    monkeypatch.setattr(app, "send_email", send_email)
+    run.notify({"success": True, "result": "done"}, {})
+    assert "Device Results: " in attachments[0]
+    assert "Austin: \n\t\tindex: 0" in attachments[0]
+    assert "Jackson" not in attachments[0]
+    db.session.delete(run)
+    db.session.commit()
+
+
+def test_service_snapshot(user_client):
+    service = db.factory(
+        "python_snippet_service",
+        name="service_snapshot",
+        scoped_name="service_snapshot",
+        source_code=(
+            "service = fetch('service', name='service_snapshot')\n"
+            "service.time_between_retries = 42\n"
+            "results['success'] = True\n"
+            "results['result'] = run.time_between_retries"
+        ),
+        creator="admin",
+        run_method="once",
+        skip_value="success",
+        time_between_retries=3,
+        commit=True,
+    )
+    runtime = app.get_time()
+    results = app.run(service.id, creator="admin", runtime=runtime)
+    assert results["result"] == 3
+    run = db.fetch("run", runtime=runtime)
+    assert run.time_between_retries == 3 and service.time_between_retries == 42
+    with raises(AttributeError):
+        run.count